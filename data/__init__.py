@@ -1,4 +1,5 @@
 import importlib
+import signal
 import torch.utils.data
 from data.base_dataset import BaseDataset
 
@@ -33,12 +34,80 @@ def get_option_setter(dataset_name):
     return dataset_class.modify_commandline_options
 
 
-def create_dataloader(opt):
+def create_dataset(opt):
     dataset = find_dataset_using_name(opt.dataset_mode)
     instance = dataset()
     instance.initialize(opt)
     print("dataset [%s] of size %d was created" %
           (type(instance).__name__, len(instance)))
+    return instance
+
+
+class ResumableBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler with a seeded order per epoch that can start in the middle of an epoch.
+    set_epoch(epoch, start) reproduces the order of that epoch and skips the first start
+    batches, so a resumed training run sees exactly the batches it had not trained on.
+    """
+    def __init__(self, n_items, batch_size, shuffle=True, drop_last=True, seed=0):
+        self.n_items = n_items
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """Set the epoch and the first batch to yield, return the batch the epoch resumes at"""
+        self.epoch = epoch
+        self.start = start
+        return self.start
+
+    def n_batches(self):
+        if self.drop_last:
+            return self.n_items // self.batch_size
+        return (self.n_items + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(self.n_items, generator=generator).tolist()
+        else:
+            order = list(range(self.n_items))
+        for k in range(self.start, self.n_batches()):
+            yield order[k*self.batch_size:(k+1)*self.batch_size]
+
+    def __len__(self):
+        return self.n_batches()
+
+
+def ignore_sigterm(worker_id):
+    # the training loop handles SIGTERM, the workers have to keep serving it until the checkpoint is saved
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def create_dataloader(opt, instance=None, indices=None):
+    """Create the dataloader, optionally restricted to the given indices of the dataset"""
+    instance = create_dataset(opt) if instance is None else instance
+    batch_sampler = instance.get_batch_sampler(opt)
+    if batch_sampler is None and opt.isTrain and indices is None:
+        # the training order is reproducible so that a run can resume in the middle of an epoch
+        batch_sampler = ResumableBatchSampler(len(instance), opt.batchSize, shuffle=not opt.serial_batches, 
+                                              drop_last=True, seed=opt.seed)
+    if indices is not None:
+        assert batch_sampler is None, "a subset can not be used together with a batch sampler"
+        instance = torch.utils.data.Subset(instance, indices)
+    if batch_sampler is not None:
+        dataloader = torch.utils.data.DataLoader(
+            instance,
+            batch_sampler=batch_sampler,
+            num_workers=int(opt.nThreads),
+            worker_init_fn=ignore_sigterm if opt.isTrain else None,
+            pin_memory=True
+        )
+        return dataloader
     dataloader = torch.utils.data.DataLoader(
         instance,
         batch_size=opt.batchSize,
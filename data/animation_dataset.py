@@ -41,8 +41,6 @@ class AnimationDataset(BaseDataset):
 
     def init_frame_idx(self, A_paths):
         self.n_of_seqs = min(len(A_paths), self.opt.max_dataset_size)         # number of sequences to train
-        self.seq_idx = 0                                                      # index for current sequence
-        self.frame_idx = self.opt.start_frame if not self.opt.isTrain else 0  # index for current frame in the sequence
 
         test_total, test_pre_load = self.opt.total_test_frames, self.opt.n_frames_pre_load_test
         if test_total is not None and test_total%test_pre_load != 0:
@@ -52,54 +50,74 @@ class AnimationDataset(BaseDataset):
                           "Change the 'total_test_frames' to %d"%(self.opt.total_test_frames, test_total) )
             self.opt.total_test_frames = test_total
 
-        self.frames_count = []                                                # number of frames in each sequence
-        for path in A_paths:
-            self.frames_count.append(len(path))
+        self.frames_count = self.get_frames_count(A_paths)                    # number of frames in each sequence
+        for seq_idx, count in enumerate(self.frames_count):
             if self.opt.total_test_frames is not None:
-                assert self.opt.total_test_frames<=len(path), "Sequence %s does not have enough frames"%(os.path.dirname(path[0]))
-        self.n_frames_total = self.opt.n_frames_total if self.opt.isTrain else self.opt.n_frames_pre_load_test
-
-
-    def update_seq_idx(self, A_paths, index):
-        if self.opt.isTrain:
-            seq_idx = index % self.n_of_seqs            
-            return None, None, None, seq_idx
-        else:
+                assert self.opt.total_test_frames<=count, "Sequence %d does not have enough frames"%(seq_idx)
+        self.test_index = [] if self.opt.isTrain else self.build_test_index()
+
+    def get_frames_count(self, A_paths):
+        return [len(path) for path in A_paths]
+
+    def build_test_index(self):
+        """Precompute the global index -> chunk table used in test mode.
+        Every chunk can then be loaded independently of the others by any worker.
+        """
+        test_index = []
+        n_frames_load = self.opt.n_frames_pre_load_test
+        for seq_idx in range(self.n_of_seqs):
             if self.opt.total_test_frames is not None:
-                self.change_seq = self.frame_idx >= (self.opt.total_test_frames + self.opt.start_frame) 
+                end_frame = min(self.opt.start_frame + self.opt.total_test_frames, self.frames_count[seq_idx])
             else:
-                self.change_seq = self.frame_idx + self.opt.n_frames_pre_load_test  >= self.frames_count[self.seq_idx]
-            if self.change_seq:
-                self.seq_idx += 1
-                self.frame_idx = self.opt.start_frame
-            return None, None, None, self.seq_idx
-
-    def get_video_params(self, opt, n_frames_total, cur_seq_len, frame_idx, img_paths):
-        if opt.isTrain:        
-            n_frames_total = min(n_frames_total, cur_seq_len)          # number of frames to load every dataset.item() 
-            n_frames_per_load = opt.max_frames_per_gpu                 # number of frames to load into GPUs at one time 
-            n_frames_per_load = min(n_frames_total, n_frames_per_load)
-            n_loadings = n_frames_total // n_frames_per_load           # how many times are needed to load entire sequence into GPUs         
-            n_frames_total = n_frames_per_load * n_loadings            # rounded overall number of frames to read from the sequence
-            
-            max_t_step = min(opt.max_t_step, cur_seq_len//n_frames_total)
-            t_step = np.random.randint(max_t_step) + 1                    # spacing between neighboring sampled frames
-            offset_max = max(1, cur_seq_len - (n_frames_total-1)*t_step)  # maximum possible index for the first frame        
-
-            start_idx = np.random.randint(offset_max)                 # offset for the first frame to load
-            if opt.debug:
-                print("loading %d frames in total, first frame starting at index %d, space between neighboring frames is %d"
-                    % (n_frames_total, start_idx, t_step))
+                end_frame = self.frames_count[seq_idx]
+            start_frames = list(range(self.opt.start_frame, end_frame - n_frames_load + 1, n_frames_load))
+            for i, frame_idx in enumerate(start_frames):
+                seq_start = i == 0
+                seq_end = i == len(start_frames) - 1
+                test_index.append((seq_idx, frame_idx, 1, n_frames_load, seq_start, seq_end))
+        return test_index
+
+    def get_seq_idx(self, index):
+        """Return (seq_idx, start_idx, t_step, n_frames, seq_start, seq_end) of the chunk to load.
+        In training the ClipChunkSampler passes the chunk itself as index.
+        seq_start/seq_end flag the first/last chunk of a clip or a test sequence.
+        """
+        if self.opt.isTrain:
+            return index
         else:
-            start_idx = frame_idx
-            t_step = 1  
-            if opt.debug:
-                print("loading %d frames in total, first frame starting at index %d, space between neighboring frames is %d"
-                    % (n_frames_total, start_idx, t_step))  
+            return self.test_index[index]
+
+    def get_item_name(self, index):
+        seq_idx, frame_idx = self.test_index[index][:2]
+        return '%d_%05d' % (seq_idx, frame_idx)
+
+    def get_item_group(self, index):
+        # the frames of a sequence are generated from the previous ones
+        return self.test_index[index][0]
+
+    def get_batch_sampler(self, opt):
+        if opt.isTrain:
+            return ClipChunkSampler(self, opt.batchSize, shuffle=not opt.serial_batches, seed=opt.seed)
+        return None
+
+    def get_video_params(self, opt, n_frames_total, cur_seq_len, rng=np.random):
+        """Randomly sample a training clip of a sequence"""
+        n_frames_total = min(n_frames_total, cur_seq_len)          # number of frames to load for one clip
+        n_frames_per_load = opt.max_frames_per_gpu                 # number of frames to load into GPUs at one time 
+        n_frames_per_load = min(n_frames_total, n_frames_per_load)
+        n_loadings = n_frames_total // n_frames_per_load           # how many times are needed to load entire sequence into GPUs         
+        n_frames_total = n_frames_per_load * n_loadings            # rounded overall number of frames to read from the sequence
+        
+        max_t_step = min(opt.max_t_step, cur_seq_len//n_frames_total)
+        t_step = rng.randint(max_t_step) + 1                          # spacing between neighboring sampled frames
+        offset_max = max(1, cur_seq_len - (n_frames_total-1)*t_step)  # maximum possible index for the first frame        
 
-        img = Image.open(img_paths[start_idx])
-        img_size = img.size
-        return n_frames_total, start_idx, t_step, img_size
+        start_idx = rng.randint(offset_max)                       # offset for the first frame to load
+        if opt.debug:
+            print("loading %d frames in total, first frame starting at index %d, space between neighboring frames is %d"
+                % (n_frames_total, start_idx, t_step))
+
+        return n_frames_total, n_frames_per_load, start_idx, t_step
 
 
 
@@ -118,20 +136,70 @@ class AnimationDataset(BaseDataset):
 
 
 
-    def concat_frame(self, A, Ai):
-        if A is None:
-            A = Ai
-        else:
-            A = torch.cat([A, Ai])
-        return A
-
-
     def __len__(self):
         if self.opt.isTrain:
             return len(self.A_paths)
         else:
-            return sum(self.frames_count)
+            return len(self.test_index)
 
 
     def name(self):
-        return 'FaceDataset'
\ No newline at end of file
+        return 'FaceDataset'
+
+
+class ClipChunkSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler streaming training clips chunk by chunk.
+    A clip of n_frames_total frames is sampled for each of batch_size sequences, then
+    the batches [chunk k of every clip] are yielded for k = 0, 1, ..., so that the
+    loader workers decode chunk k+1 while the model is trained on chunk k.
+    The order and the clips are drawn from a generator seeded with the epoch, so that
+    set_epoch(epoch, start) replays an epoch from its batch start. A clip can not be
+    entered in the middle, the start is moved back to the first chunk of its clip.
+    """
+    def __init__(self, dataset, batch_size, shuffle=True, seed=0):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """Set the epoch and the first batch to yield, return the batch the epoch actually resumes at"""
+        self.epoch = epoch
+        n_batches = 0
+        for _, _, _, n_chunks in self.sample_clips():
+            if n_batches + n_chunks > start:
+                break
+            n_batches += n_chunks
+        self.start = n_batches
+        return self.start
+
+    def sample_clips(self):
+        dataset, opt = self.dataset, self.dataset.opt
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = rng.permutation(dataset.n_of_seqs) if self.shuffle else np.arange(dataset.n_of_seqs)
+        for i in range(0, len(order) - self.batch_size + 1, self.batch_size):
+            clips = [dataset.get_video_params(opt, opt.n_frames_total, dataset.frames_count[seq_idx], rng) 
+                     for seq_idx in order[i:i+self.batch_size]]
+            n_frames_load = min([clip[1] for clip in clips])
+            n_chunks = min([clip[0] // n_frames_load for clip in clips])
+            yield order[i:i+self.batch_size], clips, n_frames_load, n_chunks
+
+    def __iter__(self):
+        n_batches = 0
+        for seq_idxs, clips, n_frames_load, n_chunks in self.sample_clips():
+            n_batches += n_chunks
+            if n_batches <= self.start:
+                continue
+            for k in range(n_chunks):
+                batch = []
+                for seq_idx, (_, _, start_idx, t_step) in zip(seq_idxs, clips):
+                    batch.append((int(seq_idx), start_idx + k*n_frames_load*t_step, t_step, n_frames_load, 
+                                  k == 0, k == n_chunks-1))
+                yield batch
+
+    def __len__(self):
+        # the clips of an epoch are drawn from its seed, counting their chunks gives the exact length
+        return sum(n_chunks for _, _, _, n_chunks in self.sample_clips())
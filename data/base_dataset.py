@@ -96,6 +96,19 @@ class BaseDataset(data.Dataset):
     def __len__(self):
         return self.dataset_size
 
+    def get_batch_sampler(self, opt):
+        """Return a custom batch sampler for the dataloader, or None to use the default one"""
+        return None
+
+    def get_item_name(self, index):
+        """Return a unique name of a test item, used to resume interrupted test runs"""
+        P1_name, P2_name = self.name_pairs[index]
+        return os.path.splitext(P1_name)[0] + '_2_' + P2_name
+
+    def get_item_group(self, index):
+        """Items of the same group depend on each other and are always run together"""
+        return index
+
     def name(self):
         assert False, "A subclass of BaseDataset must override self.name"
 
@@ -1,7 +1,14 @@
 import os.path
+import glob
+import json
+import hashlib
+import multiprocessing
+from collections import OrderedDict
 from data.animation_dataset import AnimationDataset
 from data.image_folder import make_grouped_dataset, check_path_valid
-from data.keypoint2img import interpPoints, drawEdge
+from data.keypoint2img import interpPoints, interpPointsBatch, drawEdge
+from data.video_reader import VideoReader
+from data.pack_keypoints import load_manifest
 import pandas as pd
 import numpy as np
 import torch
@@ -11,14 +18,25 @@ from PIL import Image
 import cv2
 from skimage import feature
 
+# bump when the rasterization of the face maps changes, cached maps of older versions are not reused
+FACE_MAPS_VERSION = 2
+
 
 class FaceDataset(AnimationDataset):
+    # open video containers per worker, each one holds decoder threads and a file descriptor
+    max_video_readers = 4
 
     @staticmethod
     def modify_commandline_options(parser, is_train):
         parser = AnimationDataset.modify_commandline_options(parser, is_train)
         parser.add_argument('--no_canny_edge', action='store_true', help='do *not* use canny edge as input')
         parser.add_argument('--no_dist_map', action='store_true', help='do *not* use distance transform map as input')
+        parser.add_argument('--frame_source', type=str, default='image', choices=['image', 'video'], 
+                            help='read sequences from per-frame image directories or from [phase]_videos/*.mp4 with packed keypoints')
+        parser.add_argument('--packed_keypoints', action='store_true', 
+                            help='memory-map the keypoints packed by data/pack_keypoints.py instead of reading one text file per frame')
+        parser.add_argument('--face_cache_dir', type=str, default=None, 
+                            help='if set, precompute the conditioning maps of every frame into this directory and read them memory-mapped')
 
         if is_train:
             parser.set_defaults(load_size=256)
@@ -30,7 +48,6 @@ class FaceDataset(AnimationDataset):
             parser.add_argument('--start_frame', type=int, default=0, help='frame index to start inference on')        
             parser.set_defaults(total_test_frames=None)
             parser.set_defaults(n_frames_pre_load_test=6)
-            parser.set_defaults(nThreads=1)
 
         parser.set_defaults(structure_nc=16)
         parser.set_defaults(image_nc=3)
@@ -46,51 +63,174 @@ class FaceDataset(AnimationDataset):
         return parser
 
 
+    def initialize(self, opt):
+        self.video_readers = OrderedDict()
+        self.cached_maps = {}
+        self.cache_paths = {}
+        self.frame_sizes = None
+        self.osize = [opt.load_size, opt.load_size] if isinstance(opt.load_size, int) else opt.load_size
+        AnimationDataset.initialize(self, opt)
+        if opt.face_cache_dir is not None:
+            self.build_cache()
+
     def get_paths(self, opt):
         root = opt.dataroot
         phase = 'test' if opt.phase == 'val' else opt.phase
+        if opt.frame_source == 'video':
+            dir_V = os.path.join(opt.dataroot, phase + '_videos')
+            B_paths = sorted(glob.glob(os.path.join(dir_V, '*.mp4')))
+            A_paths = [np.load(os.path.splitext(path)[0] + '.npy', mmap_mode='r') for path in B_paths]
+            return A_paths, B_paths, None
+
         dir_A = os.path.join(opt.dataroot, phase + '_keypoints')
         dir_B = os.path.join(opt.dataroot, phase + '_data')
+        if opt.packed_keypoints:
+            packed_dir, sequences = load_manifest(opt.dataroot, phase)
+            A_paths = [np.load(os.path.join(packed_dir, seq['name'] + '.npy'), mmap_mode='r') for seq in sequences]
+            B_paths = [[os.path.join(dir_B, seq['name'], f) for f in seq['frames']] for seq in sequences]
+            self.frame_sizes = [tuple(seq['size']) for seq in sequences]
+            return A_paths, B_paths, None
 
         A_paths = sorted(make_grouped_dataset(dir_A))
         B_paths = sorted(make_grouped_dataset(dir_B)) 
         check_path_valid(A_paths, B_paths)
         return A_paths, B_paths, None
 
+    def get_video_reader(self, seq_idx):
+        # readers are opened lazily so that every worker owns its decoders, the least recently used are closed
+        if seq_idx in self.video_readers:
+            self.video_readers.move_to_end(seq_idx)
+            return self.video_readers[seq_idx]
+        while len(self.video_readers) >= self.max_video_readers:
+            _, reader = self.video_readers.popitem(last=False)
+            reader.close()
+        self.video_readers[seq_idx] = VideoReader(self.B_paths[seq_idx])
+        return self.video_readers[seq_idx]
+
+    def close_video_readers(self):
+        for reader in self.video_readers.values():
+            reader.close()
+        self.video_readers = OrderedDict()
+
+    def __del__(self):
+        if getattr(self, 'video_readers', None):
+            self.close_video_readers()
+
+    def load_frames(self, seq_idx, frame_ids, load_keypoints=True):
+        """Read the keypoints and images of the given frames of a sequence"""
+        keypoints = None
+        if self.opt.frame_source == 'video':
+            if load_keypoints:
+                keypoints = self.A_paths[seq_idx][frame_ids]
+            images = self.get_video_reader(seq_idx).get_frames(frame_ids)
+            video_root = os.path.splitext(self.B_paths[seq_idx])[0]
+            image_path = [os.path.join(video_root, '%05d.png' % i) for i in frame_ids]
+            A_path = video_root + '.npy'
+        else:
+            images = [Image.open(self.B_paths[seq_idx][i]) for i in frame_ids]
+            image_path = [self.B_paths[seq_idx][i] for i in frame_ids]
+            if self.opt.packed_keypoints:
+                if load_keypoints:
+                    keypoints = self.A_paths[seq_idx][frame_ids]
+                A_path = os.path.dirname(image_path[-1])
+            else:
+                if load_keypoints:
+                    keypoints = [np.loadtxt(self.A_paths[seq_idx][i], delimiter=',') for i in frame_ids]
+                A_path = self.A_paths[seq_idx][frame_ids[-1]]
+        return keypoints, images, image_path, A_path
+
+    def get_frame_size(self, seq_idx, img):
+        if self.frame_sizes is not None:
+            return self.frame_sizes[seq_idx]
+        return img.size
+
     def __getitem__(self, index):
-        A, B, _, seq_idx = self.update_seq_idx(self.A_paths, index)        
-        A_paths = self.A_paths[seq_idx]
-        B_paths = self.B_paths[seq_idx]
-        n_frames_total, start_idx, t_step, B_size = self.get_video_params(self.opt, self.n_frames_total, len(A_paths), self.frame_idx, B_paths)
-               
-        transform_scaleA = self.get_transform(self.opt,  method=Image.BILINEAR, normalize=False)
-        transform_label = self.get_transform(self.opt,  method=Image.NEAREST, normalize=False)
+        seq_idx, start_idx, t_step, n_frames, seq_start, seq_end = self.get_seq_idx(index)
         transform_scaleB = self.get_transform(self.opt)
         
         # read in images       
-        image_path=[] 
-        frame_range = list(range(n_frames_total))  
-        for i in frame_range:
-            A_path = A_paths[start_idx + i * t_step]
-            B_path = B_paths[start_idx + i * t_step]                    
-            B_img = Image.open(B_path)
-            Ai, Li = self.get_face_image(A_path, transform_scaleA, transform_label, B_size, B_img)
-            Ai  = torch.cat([Ai, Li])
-            Bi = transform_scaleB(B_img)
-            A = self.concat_frame(A, Ai)
-            B = self.concat_frame(B, Bi)
-            image_path.append(B_path)
-        
-        if not self.opt.isTrain:
-            self.frame_idx += self.opt.n_frames_pre_load_test
-        change_seq = False if self.opt.isTrain else self.change_seq
+        frame_ids = [start_idx + i * t_step for i in range(n_frames)]
+        use_cache = self.opt.face_cache_dir is not None
+        keypoints, B_imgs, image_path, A_path = self.load_frames(seq_idx, frame_ids, load_keypoints=not use_cache)
+        if use_cache:
+            face_maps = self.get_cached_maps(seq_idx)[frame_ids]
+        else:
+            B_size = self.get_frame_size(seq_idx, B_imgs[0])
+            face_maps = [self.get_face_maps(keypoints[i], B_size, B_imgs[i]) for i in range(n_frames)]
 
+        # fill preallocated chunk tensors frame by frame
+        nc_A, nc_B = face_maps[0].shape[0], self.opt.image_nc
+        A = torch.empty(n_frames*nc_A, self.osize[0], self.osize[1])
+        B = torch.empty(n_frames*nc_B, self.osize[0], self.osize[1])
+        for i in range(n_frames):
+            A[i*nc_A:(i+1)*nc_A] = self.maps2tensor(face_maps[i])
+            B[i*nc_B:(i+1)*nc_B] = transform_scaleB(B_imgs[i])
+        
         return_list = {'BP': A, 'P': B, 'BP_path': A_path, 
-                        'P_path': image_path,'change_seq': change_seq, 'frame_idx':self.frame_idx}
+                        'P_path': image_path, 'seq_start': seq_start, 'seq_end': seq_end, 'frame_idx': start_idx}
                 
         return return_list
 
+    def get_source_files(self, seq_idx):
+        """The image or video files and the keypoint files the maps of a sequence are computed from"""
+        if self.opt.frame_source == 'video':
+            return [self.B_paths[seq_idx], self.A_paths[seq_idx].filename]
+        A_files = [self.A_paths[seq_idx].filename] if self.opt.packed_keypoints else list(self.A_paths[seq_idx])
+        return list(self.B_paths[seq_idx]) + A_files
+
+    def get_cache_path(self, seq_idx):
+        # content addressed by the path, size and mtime of the source files, the options the maps depend on 
+        # and the rasterizer version. The files are stat'ed once, the paths are passed on to the loader workers
+        if seq_idx not in self.cache_paths:
+            sources = [(path, os.path.getsize(path), os.path.getmtime(path)) for path in self.get_source_files(seq_idx)]
+            key = json.dumps([FACE_MAPS_VERSION, sources, self.osize, self.opt.no_canny_edge, self.opt.no_dist_map])
+            key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+            self.cache_paths[seq_idx] = os.path.join(self.opt.face_cache_dir, key + '.npy')
+        return self.cache_paths[seq_idx]
 
+    def get_cached_maps(self, seq_idx):
+        if seq_idx not in self.cached_maps:
+            self.cached_maps[seq_idx] = np.load(self.get_cache_path(seq_idx), mmap_mode='r')
+        return self.cached_maps[seq_idx]
+
+    def build_cache(self):
+        """Precompute the conditioning maps of all uncached sequences with a process pool"""
+        os.makedirs(self.opt.face_cache_dir, exist_ok=True)
+        # sequences without frames are never sampled and have nothing to cache
+        missing = [i for i in range(self.n_of_seqs) if self.frames_count[i] > 0 and not os.path.isfile(self.get_cache_path(i))]
+        if len(missing) == 0:
+            return
+        print('precompute face maps of %d sequences into %s' % (len(missing), self.opt.face_cache_dir))
+        n_workers = max(1, min(int(self.opt.nThreads), len(missing)))
+        # a task holds the paths of one sequence only, the memory-mapped keypoints are reopened by their file name
+        tasks = [(i, self.A_paths[i].filename if isinstance(self.A_paths[i], np.memmap) else self.A_paths[i], 
+                  self.B_paths[i], None if self.frame_sizes is None else self.frame_sizes[i], 
+                  self.frames_count[i], self.get_cache_path(i)) for i in missing]
+        with multiprocessing.Pool(n_workers, initializer=_init_cache_worker, initargs=(self.opt, self.osize)) as pool:
+            for seq_idx in pool.imap_unordered(_cache_sequence, tasks):
+                print('cached face maps of sequence %d' % seq_idx)
+
+    def write_sequence_cache(self, seq_idx, chunk_size=32):
+        """Write the (T,C,H,W) uint8 conditioning maps of one sequence"""
+        path = self.get_cache_path(seq_idx)
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        n_frames = self.frames_count[seq_idx]
+        if n_frames == 0:
+            return seq_idx
+        out = None
+        for start in range(0, n_frames, chunk_size):
+            frame_ids = list(range(start, min(start + chunk_size, n_frames)))
+            keypoints, B_imgs, _, _ = self.load_frames(seq_idx, frame_ids)
+            B_size = self.get_frame_size(seq_idx, B_imgs[0])
+            for i, frame_id in enumerate(frame_ids):
+                face_map = self.get_face_maps(keypoints[i], B_size, B_imgs[i])
+                if out is None:
+                    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(n_frames,) + face_map.shape)
+                out[frame_id] = face_map
+        out.flush()
+        del out
+        os.replace(tmp_path, path)
+        return seq_idx
 
     def get_transform(self, opt, method=Image.BICUBIC, normalize=True, toTensor=True):
         transform_list = []
@@ -113,30 +253,36 @@ class FaceDataset(AnimationDataset):
         A_scaled = transform_scaleA(A_img)
         return A_scaled
 
-    def get_face_image(self, A_path, transform_A, transform_L, size, img):
-        # read face keypoints from path
-        keypoints, part_list, part_labels = self.read_keypoints(A_path, size)
+    def get_face_maps(self, keypoints, size, img):
+        """Return the uint8 conditioning stack (edges, distance maps, part labels) of a frame"""
+        # add the upper face and build the part labels from the face keypoints
+        keypoints, part_list, part_labels = self.read_keypoints(keypoints, size)
 
         # draw edges and possibly add distance transform maps
         add_dist_map = not self.opt.no_dist_map
-        im_edges, dist_tensor = self.draw_face_edges(keypoints, part_list, transform_A, size, add_dist_map, self.osize)
+        im_edges, im_dists = self.draw_face_edges(keypoints, part_list, size, add_dist_map, self.osize)
         
+        part_labels = Image.fromarray(part_labels)
+        part_labels = F.resize(part_labels, self.osize, interpolation=Image.NEAREST)
         # canny edge for background
         if not self.opt.no_canny_edge:
             img = F.resize(img, self.osize)
-            part_labels = Image.fromarray(part_labels)
-            part_labels = F.resize(part_labels, self.osize, interpolation=Image.NEAREST)
             edges = feature.canny(np.array(img.convert('L')))        
             edges = edges * (np.array(part_labels) == 0)  # remove edges within face
             im_edges += (edges * 255).astype(np.uint8)
-        edge_tensor = transform_A(Image.fromarray(im_edges))
 
-        # final input tensor
-        input_tensor = torch.cat([edge_tensor, dist_tensor]) if add_dist_map else edge_tensor
-        label_tensor = transform_L(part_labels) * 255.0
-        return input_tensor, label_tensor
+        # final input maps
+        face_maps = [im_edges[None], im_dists] if add_dist_map else [im_edges[None]]
+        face_maps.append(np.asarray(part_labels)[None])
+        return np.concatenate(face_maps)
 
-    def read_keypoints(self, A_path, size):        
+    def maps2tensor(self, face_maps):
+        # edge and distance maps are scaled to [0,1], the last channel keeps the part labels
+        tensor = torch.from_numpy(np.array(face_maps, np.float32)).div(255)
+        tensor[-1] = tensor[-1] * 255.0
+        return tensor
+
+    def read_keypoints(self, keypoints, size):        
         # mapping from keypoints to face part 
         part_list = [[list(range(0, 17)) + list(range(68, 83)) + [0]], # face
                      [range(17, 22)],                                  # right eyebrow
@@ -148,7 +294,7 @@ class FaceDataset(AnimationDataset):
                      [range(60, 65), [64,65,66,67,60]]                 # tongue
                     ]
         label_list = [1, 2, 2, 3, 4, 4, 5, 6] # labeling for different facial parts        
-        keypoints = np.loadtxt(A_path, delimiter=',')
+        keypoints = np.asarray(keypoints)
         
         # add upper half face by symmetry
         pts = keypoints[:17, :].astype(np.int32)
@@ -167,40 +313,79 @@ class FaceDataset(AnimationDataset):
 
         return keypoints, part_list, part_labels
 
-    def draw_face_edges(self, keypoints, part_list, transform_A, size, add_dist_map, outsize=(256,256)):
+    def get_sub_edges(self, part_list, edge_len):
+        """Split every edge into sub edges of edge_len keypoints (padded to edge_len)
+        Returns the keypoint indices, the number of valid keypoints and the edge index of every sub edge
+        """
+        sub_edges, n_points, edge_ids = [], [], []
+        e = 0
+        for edge_list in part_list:
+            for edge in edge_list:
+                edge = list(edge)
+                for i in range(0, max(1, len(edge)-1), edge_len-1): # divide a long edge into multiple small edges when drawing
+                    sub_edge = edge[i:i+edge_len]
+                    n_points.append(len(sub_edge))
+                    sub_edges.append(sub_edge + [sub_edge[-1]] * (edge_len - len(sub_edge)))
+                    edge_ids.append(e)
+                e += 1
+        return np.array(sub_edges), np.array(n_points), np.array(edge_ids), e
+
+    def draw_face_edges(self, keypoints, part_list, size, add_dist_map, outsize=(256,256)):
         w, h = size
         w_o, h_o =  outsize
         edge_len = 3  # interpolate 3 keypoints to form a curve when drawing edges
-        
+        if not hasattr(self, 'sub_edges'):
+            self.sub_edges = self.get_sub_edges(part_list, edge_len)
+        sub_edges, n_points, edge_ids, n_edges = self.sub_edges
+
+        # interp keypoints of all sub edges to get the curve shapes at once
+        x = (keypoints[sub_edges, 0].astype(np.float32)/ w * w_o).astype(int)
+        y = (keypoints[sub_edges, 1].astype(np.float32)/ h * h_o).astype(int)
+        curve_x, curve_y, seg = interpPointsBatch(x, y, n_points)
+        yy = np.clip(curve_y, 0, h_o-1)
+        xx = np.clip(curve_x, 0, w_o-1)
+
         # edge map for face region from keypoints
         im_edges = np.zeros((h_o, w_o), np.uint8) # edge map for all edges
-        dist_tensor = 0
-        e = 1                
-        for edge_list in part_list:
-            for edge in edge_list:
-                im_edge = np.zeros((h_o, w_o), np.uint8) # edge map for the current edge
-                for i in range(0, max(1, len(edge)-1), edge_len-1): # divide a long edge into multiple small edges when drawing
-                    sub_edge = edge[i:i+edge_len]
-                    x = keypoints[sub_edge, 0].astype(np.float32)/ w * w_o
-                    y = keypoints[sub_edge, 1].astype(np.float32)/ h * h_o
-                                    
-                    curve_x, curve_y = interpPoints(x.astype(np.int), y.astype(np.int)) # interp keypoints to get the curve shape                    
-                    drawEdge(im_edges, curve_x, curve_y, bw=0)
-                    if add_dist_map:
-                        drawEdge(im_edge, curve_x, curve_y, bw=0)
-                                
-                if add_dist_map: # add distance transform map on each facial part
-                    im_edge_tr = Image.fromarray(im_edge).resize(self.osize, Image.NEAREST)
-                    im_edge_tr = np.asarray(im_edge_tr)
-                    im_dist = cv2.distanceTransform(255-im_edge_tr, cv2.DIST_L1, 3) 
-                    im_dist = np.clip((im_dist / 3), 0, 255).astype(np.uint8)
-                    im_dist = Image.fromarray(im_dist)
-                    tensor_cropped = transform_A(im_dist)                    
-                    dist_tensor = tensor_cropped if e == 1 else torch.cat([dist_tensor, tensor_cropped])
-                    e += 1
-
-        return im_edges, dist_tensor    
+        im_edges[yy, xx] = 255
+        im_dists = None
+        if add_dist_map: # add distance transform map on each facial part
+            im_edge_all = np.zeros((n_edges, h_o, w_o), np.uint8) # edge map for every edge
+            im_edge_all[edge_ids[seg], yy, xx] = 255
+            im_dists = np.zeros((n_edges, h_o, w_o), np.uint8)
+            for e, im_edge in enumerate(im_edge_all):
+                im_dist = cv2.distanceTransform(255-im_edge, cv2.DIST_L1, 3) 
+                im_dists[e] = np.clip((im_dist / 3), 0, 255).astype(np.uint8)
+
+        return im_edges, im_dists    
 
 
     def name(self):
-        return 'FaceDataset'
\ No newline at end of file
+        return 'FaceDataset'
+
+
+_cache_dataset = None
+
+def _init_cache_worker(opt, osize):
+    # a bare dataset holding the sequences handed to this worker, initialize() would list and cache them all again
+    global _cache_dataset
+    _cache_dataset = FaceDataset.__new__(FaceDataset)
+    _cache_dataset.opt, _cache_dataset.osize = opt, osize
+    _cache_dataset.video_readers = OrderedDict()
+    _cache_dataset.A_paths, _cache_dataset.B_paths, _cache_dataset.frames_count = {}, {}, {}
+    _cache_dataset.frame_sizes = {} if opt.frame_source == 'image' and opt.packed_keypoints else None
+    _cache_dataset.cache_paths = {}
+
+def _cache_sequence(task):
+    seq_idx, A_path, B_path, frame_size, n_frames, cache_path = task
+    dataset = _cache_dataset
+    dataset.A_paths[seq_idx] = np.load(A_path, mmap_mode='r') if isinstance(A_path, str) else A_path
+    dataset.B_paths[seq_idx], dataset.frames_count[seq_idx], dataset.cache_paths[seq_idx] = B_path, n_frames, cache_path
+    if dataset.frame_sizes is not None:
+        dataset.frame_sizes[seq_idx] = frame_size
+    try:
+        return dataset.write_sequence_cache(seq_idx)
+    finally:
+        # the sequence is done, release its video decoder and keypoint map
+        dataset.close_video_readers()
+        del dataset.A_paths[seq_idx]
@@ -3,7 +3,7 @@ from PIL import Image
 import numpy as np
 import json
 import glob
-from scipy.optimize import curve_fit
+from scipy.optimize import curve_fit, leastsq
 import warnings
 
 def func(x, a, b, c):    
@@ -26,6 +26,19 @@ def setColor(im, yy, xx, color):
 def drawEdge(im, x, y, bw=1, color=(255,255,255), draw_end_points=False):
     if x is not None and x.size:
         h, w = im.shape[0], im.shape[1]
+        if len(im.shape) == 2:
+            # a single channel gets a constant color, all offsets are drawn at once
+            offsets = [(i, j) for i in range(-bw, bw) for j in range(-bw, bw)] if bw > 0 else [(0, 0)]
+            yy = (y[None,:] + np.array([i for i, _ in offsets])[:,None]).ravel()
+            xx = (x[None,:] + np.array([j for _, j in offsets])[:,None]).ravel()
+            if draw_end_points and bw > 0:
+                offsets = [(i, j) for i in range(-bw*2, bw*2) for j in range(-bw*2, bw*2) if (i**2) + (j**2) < (4 * bw**2)]
+                yy = np.concatenate([yy, (np.array([y[0], y[-1]])[None,:] + np.array([i for i, _ in offsets])[:,None]).ravel()])
+                xx = np.concatenate([xx, (np.array([x[0], x[-1]])[None,:] + np.array([j for _, j in offsets])[:,None]).ravel()])
+            im[np.clip(yy, 0, h-1), np.clip(xx, 0, w-1)] = color[0]
+            return
+
+        # colors are blended with the pixels drawn before, so the offsets are drawn in order
         # edge
         for i in range(-bw, bw):
             for j in range(-bw, bw):
@@ -70,6 +83,86 @@ def interpPoints(x, y):
             curve_y = func(curve_x, *popt)
     return curve_x.astype(int), curve_y.astype(int)
 
+_fit_cache = {}
+_fit_cache_size = 1 << 16
+
+def fitCurve(x, y):
+    """
+    The parameters curve_fit returns in interpPoints, or None when the quadratic is rejected.
+    leastsq is called the way curve_fit calls it, which gives bit-identical parameters without
+    the overhead of curve_fit. The results are memoized on the coordinates.
+    """
+    key = (tuple(x), tuple(y))
+    if key in _fit_cache:
+        return _fit_cache[key]
+    f, n_params = (linear, 2) if len(x) < 3 else (func, 3)
+    xdata, ydata = np.asarray(x, float), np.asarray(y, float)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        popt, _, _, errmsg, ier = leastsq(lambda p: f(xdata, *p) - ydata, np.ones(n_params), full_output=1)
+    if ier not in [1, 2, 3, 4]:
+        raise RuntimeError("Optimal parameters not found: " + errmsg)
+    if len(x) >= 3 and abs(popt[0]) > 1:
+        popt = None
+    if len(_fit_cache) >= _fit_cache_size:
+        _fit_cache.clear()
+    _fit_cache[key] = popt
+    return popt
+
+def interpPointsBatch(x, y, n_points):
+    """
+    interpPoints for N short polylines, with the same output pixel for pixel.
+    x, y: (N,P) coordinates (entries beyond n_points are ignored)
+    n_points: (N,) number of valid points of each polyline
+    The curves are fitted one by one with fitCurve, the sampling and the evaluation of
+    all curves are done at once with the same floating point operations as interpPoints.
+    Returns the int coordinates of all curve points and the polyline index of each point.
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    n_points = np.asarray(n_points)
+    rows = np.arange(len(x))
+    last = n_points - 1
+
+    # fit along the axis with the larger extent
+    valid = np.arange(x.shape[1]-1)[None,:] < last[:,None]
+    dx = np.where(valid, np.abs(x[:,:-1] - x[:,1:]), 0).max(1)
+    dy = np.where(valid, np.abs(y[:,:-1] - y[:,1:]), 0).max(1)
+    swap = dx < dy
+    u = np.where(swap[:,None], y, x)
+    v = np.where(swap[:,None], x, y)
+
+    quad = n_points >= 3
+    coef = np.zeros((len(x), 3))
+    accepted = np.ones(len(x), bool)
+    for i in rows:
+        popt = fitCurve(u[i,:n_points[i]], v[i,:n_points[i]])
+        if popt is None:
+            accepted[i] = False
+        else:
+            coef[i,:len(popt)] = popt
+
+    # sample the curves as np.linspace(start, stop, stop-start) does
+    u_first, u_last = u[rows, 0], u[rows, last]
+    start = np.minimum(u_first, u_last).astype(np.float64)
+    stop = np.maximum(u_first, u_last).astype(np.float64)
+    num = np.where(accepted, (stop - start).astype(np.int64), 0)
+    seg = np.repeat(rows, num)
+    k = np.arange(num.sum()) - np.repeat(np.cumsum(num) - num, num)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        step = np.where(num > 1, (stop - start) / (num - 1), 0.0)
+    curve_u = k * step[seg] + start[seg]
+    end = (k == num[seg] - 1) & (num[seg] > 1)
+    curve_u[end] = stop[seg][end]
+
+    # evaluate func or linear on the samples
+    a, b, c = coef[seg,0], coef[seg,1], coef[seg,2]
+    curve_v = np.where(quad[seg], a * curve_u**2 + b * curve_u + c, a * curve_u + b)
+
+    curve_u, curve_v = curve_u.astype(int), curve_v.astype(int)
+    curve_x = np.where(swap[seg], curve_v, curve_u)
+    curve_y = np.where(swap[seg], curve_u, curve_v)
+    return curve_x, curve_y, seg
+
 def read_keypoints(json_input, size, random_drop_prob=0, remove_face_labels=False, basic_point_only=False):
     with open(json_input, encoding='utf-8') as f:
         keypoint_dicts = json.loads(f.read())["people"]
@@ -119,12 +212,13 @@ def connect_keypoints(pts, edge_lists, size, random_drop_prob, remove_face_label
         face_pts[:,0] += 2 * np.random.randn()
         face_pts[:,1] += 2 * np.random.randn()
 
+    # collect the edges to draw, the random drops are drawn in the order of the drawing loops
+    edges = []
     ### pose    
     for i, edge in enumerate(pose_edge_list):
         x, y = pose_pts[edge, 0], pose_pts[edge, 1]
         if (np.random.rand() > random_drop_prob) and (0 not in x):
-            curve_x, curve_y = interpPoints(x, y)                                        
-            drawEdge(output_edges, curve_x, curve_y, bw=3, color=pose_color_list[i], draw_end_points=True)
+            edges.append((x, y, 3, pose_color_list[i]))
 
     if not basic_point_only:
         ### hand       
@@ -135,8 +229,7 @@ def connect_keypoints(pts, edge_lists, size, random_drop_prob, remove_face_label
                         sub_edge = edge[j:j+2] 
                         x, y = hand_pts[sub_edge, 0], hand_pts[sub_edge, 1]                    
                         if 0 not in x:
-                            line_x, line_y = interpPoints(x, y)                                        
-                            drawEdge(output_edges, line_x, line_y, bw=1, color=hand_color_list[i], draw_end_points=True)
+                            edges.append((x, y, 1, hand_color_list[i]))
 
         ### face
         edge_len = 2
@@ -147,8 +240,19 @@ def connect_keypoints(pts, edge_lists, size, random_drop_prob, remove_face_label
                         sub_edge = edge[i:i+edge_len]
                         x, y = face_pts[sub_edge, 0], face_pts[sub_edge, 1]
                         if 0 not in x:
-                            curve_x, curve_y = interpPoints(x, y)
-                            drawEdge(output_edges, curve_x, curve_y, draw_end_points=True)
+                            edges.append((x, y, 1, (255,255,255)))
+
+    if len(edges) == 0:
+        return output_edges
+    # interp all edges at once, then draw them in order since the colors are blended
+    n_points = np.array([len(x) for x, _, _, _ in edges])
+    x = np.stack([np.pad(x, (0, 2-len(x)), 'edge') for x, _, _, _ in edges])
+    y = np.stack([np.pad(y, (0, 2-len(y)), 'edge') for _, y, _, _ in edges])
+    curve_x, curve_y, seg = interpPointsBatch(x, y, n_points)
+    bounds = np.searchsorted(seg, np.arange(len(edges)+1))
+    for e, (_, _, bw, color) in enumerate(edges):
+        curve = slice(bounds[e], bounds[e+1])
+        drawEdge(output_edges, curve_x[curve], curve_y[curve], bw=bw, color=color, draw_end_points=True)
 
     return output_edges
 
@@ -0,0 +1,58 @@
+import os
+import json
+import argparse
+import numpy as np
+from PIL import Image
+from data.image_folder import make_grouped_dataset, check_path_valid
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def load_keypoint_files(keypoint_paths):
+    """Stack the per-frame keypoint text files of a sequence into a (T,K,2) float32 array"""
+    return np.stack([np.loadtxt(path, delimiter=',') for path in keypoint_paths]).astype(np.float32)
+
+
+def pack_keypoints(dataroot, phase):
+    """
+    Consolidate the per-frame keypoint text files of every sequence in
+    [phase]_keypoints into one (T,K,2) float32 array [phase]_keypoints_packed/<seq>.npy
+    and write a manifest with the frame names, frame count and frame size of each sequence
+    """
+    A_paths = sorted(make_grouped_dataset(os.path.join(dataroot, phase + '_keypoints')))
+    B_paths = sorted(make_grouped_dataset(os.path.join(dataroot, phase + '_data')))
+    check_path_valid(A_paths, B_paths)
+
+    out_dir = os.path.join(dataroot, phase + '_keypoints_packed')
+    os.makedirs(out_dir, exist_ok=True)
+    sequences = []
+    for A_path, B_path in zip(A_paths, B_paths):
+        seq_name = os.path.basename(os.path.dirname(B_path[0]))
+        keypoints = load_keypoint_files(A_path)
+        np.save(os.path.join(out_dir, seq_name + '.npy'), keypoints)
+        width, height = Image.open(B_path[0]).size
+        sequences.append({'name': seq_name,
+                          'n_frames': len(B_path),
+                          'size': [width, height],
+                          'frames': [os.path.basename(path) for path in B_path]})
+        print('pack keypoints of sequence %s (%d frames)' % (seq_name, len(B_path)))
+
+    with open(os.path.join(out_dir, MANIFEST_NAME), 'w') as f:
+        json.dump({'phase': phase, 'sequences': sequences}, f)
+    return sequences
+
+
+def load_manifest(dataroot, phase):
+    """Return the packed keypoint directory and the sequence entries of its manifest"""
+    packed_dir = os.path.join(dataroot, phase + '_keypoints_packed')
+    with open(os.path.join(packed_dir, MANIFEST_NAME), 'r') as f:
+        manifest = json.load(f)
+    return packed_dir, manifest['sequences']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack per-frame face keypoints into one array per sequence')
+    parser.add_argument('--dataroot', type=str, required=True)
+    parser.add_argument('--phase', type=str, default='train')
+    args = parser.parse_args()
+    pack_keypoints(args.dataroot, args.phase)
@@ -16,6 +16,8 @@ class ShapeNetDataset(BaseDataset):
         parser.add_argument('--label_nc_h', type=int, default=18 )
         parser.add_argument('--label_nc_v', type=int, default=3 )
         parser.add_argument('--sub_dataset_model', type=str, default='car')
+        parser.add_argument('--hdf5_in_memory', action='store_true', 
+                            help='read the whole hdf5 file at startup into one pre-resized shared memory array')
 
         parser.set_defaults(load_size=256)
         parser.set_defaults(image_nc=3)
@@ -36,6 +38,9 @@ class ShapeNetDataset(BaseDataset):
         self.trans = transforms.Compose(transform_list) 
         self.hdf5_data = None
         # self.hdf5_data = h5py.File(self.hdf5_file, 'r')
+        self.memory_images = None
+        if opt.hdf5_in_memory:
+            self.load_to_memory()
         self.angle_list = range(0, 360, opt.ang_skip)
         if not self.opt.isTrain:
             self.image_names = np.genfromtxt(self.image_name_file, dtype=np.str)
@@ -50,8 +55,51 @@ class ShapeNetDataset(BaseDataset):
         hdf5_file = os.path.join(root, 'data_%s.hdf5'% opt.sub_dataset_model)
         return image_id_file, hdf5_file, image_name_file     
 
+    def load_to_memory(self):
+        """
+        Bulk read all images and poses of the hdf5 file in storage order. The images are
+        resized once and kept as one uint8 (N,H,W,C) tensor in shared memory, so that
+        all dataloader workers serve samples by slicing it.
+        """
+        with h5py.File(self.hdf5_file, 'r') as hdf5_data:
+            ids = list(hdf5_data.keys())
+            # sort by the file offset of the images to read the file sequentially
+            offsets = [hdf5_data[i]['image'].id.get_offset() for i in ids]
+            if all(offset is not None for offset in offsets):
+                ids = [ids[i] for i in np.argsort(offsets, kind='stable')]
+
+            size = (self.opt.load_size, self.opt.load_size)
+            images, poses = None, []
+            for row, image_id in enumerate(ids):
+                group = hdf5_data[image_id]
+                img = Image.fromarray(np.uint8(group['image'][()])).resize(size[::-1], Image.BILINEAR)
+                img = np.asarray(img)
+                if images is None:
+                    images = torch.empty((len(ids),) + img.shape, dtype=torch.uint8).share_memory_()
+                images[row] = torch.from_numpy(img)
+                poses.append(group['pose'][()])
+
+        self.memory_images = images
+        self.memory_poses = torch.from_numpy(np.stack(poses)).share_memory_()
+        self.memory_index = {image_id: row for row, image_id in enumerate(ids)}
+        print('load %d images of %s into memory (%.1f MB)' 
+              % (len(ids), self.hdf5_file, images.numel() / 1024.0 / 1024.0))
+
+    def load_image(self, image_id):
+        if self.memory_images is not None:
+            img = self.memory_images[self.memory_index[image_id]]
+            img = img.permute(2, 0, 1).float().div(255)
+            return (img - 0.5) / 0.5
+        img = self.hdf5_data[image_id]['image'][()]
+        return self.trans(Image.fromarray(np.uint8(img)))
+
+    def load_pose(self, image_id):
+        if self.memory_images is not None:
+            return self.memory_poses[self.memory_index[image_id]].clone().view(-1, 1, 1)
+        return torch.tensor(self.hdf5_data[image_id]['pose'][()]).view(-1, 1, 1)
+
     def __getitem__(self, index):
-        if self.hdf5_data is None:
+        if self.hdf5_data is None and self.memory_images is None:
             # follow the solution at 
             # https://discuss.pytorch.org/t/dataloader-when-num-worker-0-there-is-bug/25643/16
             # to sovle multi-thread read of HDF5 file 
@@ -62,18 +110,11 @@ class ShapeNetDataset(BaseDataset):
             source_id = source_id.decode("utf-8") if isinstance(source_id, bytes) else source_id
             target_id = self.get_random_target_id(source_id)
 
+            P1 = self.load_image(source_id)
+            P2 = self.load_image(target_id)
 
-            P1_img = self.hdf5_data[source_id]['image'][()]
-            P2_img = self.hdf5_data[target_id]['image'][()]
-
-            P1_img = Image.fromarray(np.uint8(P1_img))
-            P2_img = Image.fromarray(np.uint8(P2_img))
-
-            P1 = self.trans(P1_img)
-            P2 = self.trans(P2_img)
-
-            BP1 = torch.tensor(self.hdf5_data[source_id]['pose'][()]).view(-1, 1, 1)
-            BP2 = torch.tensor(self.hdf5_data[target_id]['pose'][()]).view(-1, 1, 1)
+            BP1 = self.load_pose(source_id)
+            BP2 = self.load_pose(target_id)
 
         else:
             source_names = self.image_names[index]
@@ -83,10 +124,8 @@ class ShapeNetDataset(BaseDataset):
             random_v_angle = str(0)            
             source_id = source_names+ '_' + random_h_angle + '_' + random_v_angle
 
-            P1_img = self.hdf5_data[source_id]['image'][()]
-            P1_img = Image.fromarray(np.uint8(P1_img))
-            P1 = self.trans(P1_img)
-            BP1 = torch.tensor(self.hdf5_data[source_id]['pose'][()]).view(-1, 1, 1)
+            P1 = self.load_image(source_id)
+            BP1 = self.load_pose(source_id)
 
             P2 = []
             BP2 = []
@@ -95,9 +134,7 @@ class ShapeNetDataset(BaseDataset):
             for ang in self.angle_list:
                 t_b = torch.LongTensor([int(ang/10),int(random_v_angle)]).view(-1, 1, 1)
                 t_id=source_names+ '_' + str(int(ang/10)) + '_' + random_v_angle
-                t_img = self.hdf5_data[t_id]['image'][()]
-                t_img = Image.fromarray(np.uint8(t_img))
-                t_img = self.trans(t_img)
+                t_img = self.load_image(t_id)
 
                 BP2.append(t_b)
                 target_id.append(t_id)
@@ -107,6 +144,11 @@ class ShapeNetDataset(BaseDataset):
 
 
 
+    def get_item_name(self, index):
+        source_names = self.image_names[index]
+        source_names = source_names.decode("utf-8") if isinstance(source_names, bytes) else source_names
+        return '%s_%d' % (source_names, index)
+
     def get_random_target_id(self, source_id):
         target_angle = int(np.random.choice(self.angle_list)/10)
         id_base = source_id.split('_')[0]
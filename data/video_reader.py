@@ -0,0 +1,147 @@
+import os
+import argparse
+import numpy as np
+from PIL import Image
+from data.pack_keypoints import load_keypoint_files
+
+
+def build_video_index(video_path):
+    """Demux (without decoding) a video and return the presentation timestamp
+    of every frame in display order together with a keyframe flag per frame.
+    """
+    import av
+    pts, keyframes = [], []
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        for packet in container.demux(stream):
+            if packet.pts is None:
+                continue
+            pts.append(packet.pts)
+            keyframes.append(packet.is_keyframe)
+    order = np.argsort(pts, kind='stable')
+    return np.array(pts, np.int64)[order], np.array(keyframes, bool)[order]
+
+
+def load_video_index(video_path, index_path=None):
+    """Load the keyframe index of a video, building and caching it if necessary"""
+    index_path = os.path.splitext(video_path)[0] + '.index.npz' if index_path is None else index_path
+    if os.path.isfile(index_path):
+        index = np.load(index_path)
+        return index['pts'], index['keyframes']
+
+    pts, keyframes = build_video_index(video_path)
+    tmp_path = index_path + '.tmp.npz'
+    np.savez(tmp_path, pts=pts, keyframes=keyframes)
+    os.replace(tmp_path, index_path)
+    return pts, keyframes
+
+
+class VideoReader():
+    """
+    Random access to the frames of a single video file.
+    Reads seek to the closest keyframe before the requested frame only when
+    the frame cannot be reached by decoding forward from the current position,
+    so sequential clip reads never re-seek.
+    """
+    def __init__(self, video_path, index_path=None):
+        self.video_path = video_path
+        self.pts, self.keyframes = load_video_index(video_path, index_path)
+        self.keyframe_ids = np.flatnonzero(self.keyframes)
+        self.container = None
+        self.stream = None
+        self.decoder = None
+        self.next_frame = None  # number of the frame the decoder will return next
+
+    def __len__(self):
+        return len(self.pts)
+
+    def open(self):
+        import av
+        self.container = av.open(self.video_path)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = 'AUTO'
+
+    def close(self):
+        if self.container is not None:
+            self.container.close()
+        self.container, self.stream, self.decoder, self.next_frame = None, None, None, None
+
+    def keyframe_before(self, frame_idx):
+        i = np.searchsorted(self.keyframe_ids, frame_idx, side='right') - 1
+        return int(self.keyframe_ids[max(i, 0)])
+
+    def seek(self, frame_idx):
+        self.container.seek(int(self.pts[frame_idx]), stream=self.stream, backward=True, any_frame=False)
+        self.decoder = self.container.decode(self.stream)
+        self.next_frame = frame_idx
+
+    def get_frame(self, frame_idx):
+        """Decode one frame and return it as a RGB PIL image"""
+        if self.container is None:
+            self.open()
+        keyframe = self.keyframe_before(frame_idx)
+        if self.next_frame is None or frame_idx < self.next_frame or keyframe > self.next_frame:
+            self.seek(keyframe)
+
+        for frame in self.decoder:
+            current = int(np.searchsorted(self.pts, frame.pts))
+            self.next_frame = current + 1
+            if current == frame_idx:
+                return frame.to_image()
+            if current > frame_idx:
+                break
+        # the decoder overshot or ran out of frames, restart from the keyframe
+        self.next_frame = None
+        raise IndexError('Cannot decode frame %d from %s' % (frame_idx, self.video_path))
+
+    def get_frames(self, frame_ids):
+        """Decode a list of frames given in increasing order"""
+        return [self.get_frame(i) for i in frame_ids]
+
+
+def write_sequence_video(image_paths, keypoint_paths, video_path, fps=30, gop_size=30, crf=18):
+    """
+    Convert a sequence stored as per-frame image and keypoint files into a
+    video file plus a single (T,K,2) float32 keypoint array <name>.npy
+    """
+    import av
+    keypoints = load_keypoint_files(keypoint_paths)
+    np.save(os.path.splitext(video_path)[0] + '.npy', keypoints)
+
+    first = Image.open(image_paths[0])
+    with av.open(video_path, mode='w') as container:
+        stream = container.add_stream('libx264', rate=fps)
+        stream.width, stream.height = first.size
+        stream.pix_fmt = 'yuv420p'
+        stream.codec_context.gop_size = gop_size
+        stream.options = {'crf': str(crf)}
+        for path in image_paths:
+            frame = av.VideoFrame.from_image(Image.open(path).convert('RGB'))
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    load_video_index(video_path)
+
+
+if __name__ == '__main__':
+    from data.image_folder import make_grouped_dataset, check_path_valid
+
+    parser = argparse.ArgumentParser(description='Convert face sequences to videos with packed keypoints')
+    parser.add_argument('--dataroot', type=str, required=True)
+    parser.add_argument('--phase', type=str, default='train')
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--gop_size', type=int, default=30, help='distance between two keyframes')
+    args = parser.parse_args()
+
+    A_paths = sorted(make_grouped_dataset(os.path.join(args.dataroot, args.phase + '_keypoints')))
+    B_paths = sorted(make_grouped_dataset(os.path.join(args.dataroot, args.phase + '_data')))
+    check_path_valid(A_paths, B_paths)
+
+    out_dir = os.path.join(args.dataroot, args.phase + '_videos')
+    os.makedirs(out_dir, exist_ok=True)
+    for A_path, B_path in zip(A_paths, B_paths):
+        seq_name = os.path.basename(os.path.dirname(B_path[0]))
+        video_path = os.path.join(out_dir, seq_name + '.mp4')
+        print('write video %s' % video_path)
+        write_sequence_video(B_path, A_path, video_path, args.fps, args.gop_size)
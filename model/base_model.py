@@ -1,12 +1,33 @@
-import os, ntpath
+import os, ntpath, glob
 import numpy as np
 import torch
 from collections import OrderedDict
 from util import util, pose_utils
+from util.result_writer import ResultWriter
+from util.shard_store import ShardWriter
+from util.checkpoint import CheckpointWriter
 from model.networks import base_function
 import matplotlib.pyplot as plt
 
 
+def load_state(path):
+    """Read a checkpoint memory-mapped when the torch version supports it, tensors are read on access"""
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except (TypeError, RuntimeError):
+        # older torch versions or checkpoints in the legacy format
+        return torch.load(path, map_location='cpu')
+
+
+def load_state_dict(net, state_dict, assign=False):
+    if assign:
+        try:
+            return net.load_state_dict(state_dict, assign=True)
+        except TypeError:
+            pass
+    return net.load_state_dict(state_dict)
+
+
 class BaseModel():
     def __init__(self, opt):
         self.opt = opt
@@ -20,6 +41,10 @@ class BaseModel():
         self.image_paths = []
         self.optimizers = []
         self.schedulers = []
+        # models may change results_dir per sequence, the result store is rooted here
+        self.results_root = getattr(opt, 'results_dir', None)
+        # test networks are overwritten by the checkpoint, skip their weight initialization
+        opt.skip_init = not self.isTrain and self.has_checkpoint(opt.which_iter)
 
     def name(self):
         return 'BaseModel'
@@ -33,6 +58,10 @@ class BaseModel():
         """Unpack input data from the dataloader and perform necessary pre-processing steps"""
         pass
 
+    def get_synthetic_input(self):
+        """Return a random batch in the format of the dataloader, used by util/module_report.py"""
+        raise NotImplementedError('model [%s] does not provide synthetic inputs' % type(self).__name__)
+
     def eval(self):
         pass
 
@@ -40,9 +69,14 @@ class BaseModel():
         """Load networks, create schedulers"""
         if self.isTrain:
             self.schedulers = [base_function.get_scheduler(optimizer, opt) for optimizer in self.optimizers]
+        self.train_state = {}
         if not self.isTrain or opt.continue_train:
             print('model resumed from %s iteration'%opt.which_iter)
             self.load_networks(opt.which_iter)
+        if self.isTrain and opt.continue_train:
+            self.train_state = self.load_train_state(opt.which_iter)
+            if 'iteration' in self.train_state:
+                opt.iter_count = self.train_state['iteration']
 
     def set_model_to_eval_mode(self):
         """Make models eval mode during test time"""
@@ -120,11 +154,12 @@ class BaseModel():
             result = value.astype(np.uint8)            
 
         elif value.size(1) == 16 and 'flow' not in name: # face map
-            value = np.transpose(value[0,0,...].unsqueeze(0).detach().cpu().numpy(),(1,2,0))
-            result = (value*255).astype(np.uint8)
+            # the edge channel is in [0,1], converted on the device like the images
+            result = util.tensor2im_batch(value[:1,:1]*2-1)[0]
 
         else:
-            result = util.tensor2im(value.data)
+            value = value.unsqueeze(0) if value.dim() == 3 else value
+            result = util.tensor2im_batch(value[:1])[0]
         return result
 
     def get_current_dis(self):
@@ -139,62 +174,122 @@ class BaseModel():
         return dis_ret
 
     # save model
-    def save_networks(self, which_epoch):
-        """Save all the networks to the disk"""
+    def save_networks(self, which_epoch, train_state=None):
+        """Save all the networks to the disk, with the optimizers and schedulers if a training state is given"""
+        files = []
         for name in self.model_names:
             if isinstance(name, str):
                 save_filename = '%s_net_%s.pth' % (which_epoch, name)
                 save_path = os.path.join(self.save_dir, save_filename)
                 net = getattr(self, 'net_' + name)
-                torch.save(net.cpu().state_dict(), save_path)
-                if len(self.gpu_ids) > 0 and torch.cuda.is_available():
-                    net.cuda()
+                files.append(('net_' + name, save_path, net.state_dict()))
+        if getattr(self.opt, 'checkpoint_format', 'separate') == 'consolidated':
+            # a single file holding all networks, memory-mapped when loaded
+            nets = dict((key, state) for key, _, state in files)
+            if train_state is not None:
+                nets['iteration'] = train_state['iteration']
+            elif str(which_epoch).isdigit():
+                nets['iteration'] = int(which_epoch)
+            files = [('nets', os.path.join(self.save_dir, '%s_nets.pth' % which_epoch), nets)]
+        if train_state is not None:
+            state = dict(train_state)
+            state['optimizers'] = [optimizer.state_dict() for optimizer in self.optimizers]
+            state['schedulers'] = [scheduler.state_dict() for scheduler in self.schedulers]
+            save_path = os.path.join(self.save_dir, '%s_train_state.pth' % which_epoch)
+            files.append(('train_state', save_path, state))
+        # the state is copied to host buffers and written in the background
+        if getattr(self, 'checkpoint_writer', None) is None:
+            self.checkpoint_writer = CheckpointWriter()
+        self.checkpoint_writer.save(files)
+
+    def wait_for_checkpoint(self):
+        """Block until the last checkpoint is written"""
+        if getattr(self, 'checkpoint_writer', None) is not None:
+            self.checkpoint_writer.wait()
+
+    def load_train_state(self, which_epoch):
+        """Restore the optimizers and schedulers, return the saved training progress"""
+        path = os.path.join(self.save_dir, '%s_train_state.pth' % which_epoch)
+        if not os.path.isfile(path):
+            print('do not find training state %s, optimizers start from scratch' % path)
+            return {}
+        state = torch.load(path, map_location='cpu')
+        for optimizer, optimizer_state in zip(self.optimizers, state.pop('optimizers')):
+            optimizer.load_state_dict(optimizer_state)
+        for scheduler, scheduler_state in zip(self.schedulers, state.pop('schedulers')):
+            scheduler.load_state_dict(scheduler_state)
+        print('load training state from %s' % path)
+        return state
 
     # load models
     def load_networks(self, which_epoch):
-        """Load all the networks from the disk"""
+        """Load all the networks from the disk, from the consolidated checkpoint if it exists"""
+        consolidated_path = os.path.join(self.save_dir, '%s_nets.pth' % which_epoch)
+        consolidated = load_state(consolidated_path) if os.path.isfile(consolidated_path) else None
         for name in self.model_names:
             if isinstance(name, str):
-                filename = '%s_net_%s.pth' % (which_epoch, name)
-                path = os.path.join(self.save_dir, filename)
                 net = getattr(self, 'net_' + name)
-                try:
-                    net.load_state_dict(torch.load(path))
-                    print('load %s from %s' % (name, filename))
-                except FileNotFoundError:
-                    print('do not find checkpoint for network {} ,path={}'.format(name,path))
-                    continue
-                except:
-                    pretrained_dict = torch.load(path)
-                    model_dict = net.state_dict()
-                    try:
-                        pretrained_dict_ = {k:v for k,v in pretrained_dict.items() if k in model_dict}
-                        if len(pretrained_dict_)==0:
-                            pretrained_dict_ = {k.replace('module.',''):v for k,v in pretrained_dict.items() if k.replace('module.','') in model_dict}
-                        if len(pretrained_dict_)==0:
-                            pretrained_dict_ = {('module.'+k):v for k,v in pretrained_dict.items() if 'module.'+k in model_dict}
-
-                        pretrained_dict = pretrained_dict_
-                        net.load_state_dict(pretrained_dict)
-                        print('Pretrained network %s has excessive layers; Only loading layers that are used' % name)
-                    except:
-                        print('Pretrained network %s has fewer layers; The following are not initialized:' % name)
-                        not_initialized = set()
-                        for k, v in pretrained_dict.items():
-                            if v.size() == model_dict[k].size():
-                                model_dict[k] = v
-
-                        for k, v in model_dict.items():
-                            if k not in pretrained_dict or v.size() != pretrained_dict[k].size():
-                                # not_initialized.add(k)
-                                not_initialized.add(k.split('.')[0])
-                        print(sorted(not_initialized))
-                        net.load_state_dict(model_dict)
+                if consolidated is not None and 'net_' + name in consolidated:
+                    filename = os.path.basename(consolidated_path)
+                    pretrained_dict = consolidated['net_' + name]
+                    if 'iteration' in consolidated:
+                        self.opt.iter_count = int(consolidated['iteration'])
+                    elif str(which_epoch).isdigit():
+                        self.opt.iter_count = int(which_epoch)
+                else:
+                    filename = '%s_net_%s.pth' % (which_epoch, name)
+                    path = os.path.join(self.save_dir, filename)
+                    if not os.path.isfile(path):
+                        print('do not find checkpoint for network {} ,path={}'.format(name,path))
+                        continue
+                    pretrained_dict = load_state(path)
+                    self.opt.iter_count = util.get_iteration(self.save_dir, filename, name)
+                self.load_network_state(net, pretrained_dict, name, filename)
                 if len(self.gpu_ids) > 0 and torch.cuda.is_available():
                     net.cuda()
                 if not self.isTrain:
                     net.eval()
-                self.opt.iter_count = util.get_iteration(self.save_dir, filename, name)   
+
+    def load_network_state(self, net, pretrained_dict, name, filename):
+        """Load a state dict that was read once, tolerating DataParallel prefixes and changed layers"""
+        # parameters of cpu networks directly use the memory-mapped tensors
+        assign = len(self.gpu_ids) == 0
+        try:
+            load_state_dict(net, pretrained_dict, assign)
+            print('load %s from %s' % (name, filename))
+            return
+        except RuntimeError:
+            pass
+        model_dict = net.state_dict()
+        try:
+            pretrained_dict_ = {k:v for k,v in pretrained_dict.items() if k in model_dict}
+            if len(pretrained_dict_)==0:
+                pretrained_dict_ = {k.replace('module.',''):v for k,v in pretrained_dict.items() if k.replace('module.','') in model_dict}
+            if len(pretrained_dict_)==0:
+                pretrained_dict_ = {('module.'+k):v for k,v in pretrained_dict.items() if 'module.'+k in model_dict}
+
+            pretrained_dict = pretrained_dict_
+            load_state_dict(net, pretrained_dict, assign)
+            print('Pretrained network %s has excessive layers; Only loading layers that are used' % name)
+        except RuntimeError:
+            print('Pretrained network %s has fewer layers; The following are not initialized:' % name)
+            not_initialized = set()
+            for k, v in pretrained_dict.items():
+                if k in model_dict and v.size() == model_dict[k].size():
+                    model_dict[k] = v
+
+            for k, v in model_dict.items():
+                if k not in pretrained_dict or v.size() != pretrained_dict[k].size():
+                    # not_initialized.add(k)
+                    not_initialized.add(k.split('.')[0])
+            print(sorted(not_initialized))
+            net.load_state_dict(model_dict)
+
+    def has_checkpoint(self, which_epoch):
+        """Whether networks of the given iteration exist in the checkpoint directory"""
+        if os.path.isfile(os.path.join(self.save_dir, '%s_nets.pth' % which_epoch)):
+            return True
+        return len(glob.glob(os.path.join(self.save_dir, '%s_net_*.pth' % which_epoch))) > 0
 
 
     # def save_results(self, save_data, score=None, data_name='none'):
@@ -221,20 +316,58 @@ class BaseModel():
 
 
 
-    def save_results(self, save_data, data_name='none', data_ext='jpg'):
-        """Save the training or testing results to disk"""
+    def get_result_names(self, n, data_name='none', data_ext='jpg'):
+        """File names of the results of the current batch"""
         img_paths = self.get_image_paths()
-
-        for i in range(save_data.size(0)):
-            print('process image ...... %s' % img_paths[i])
+        names = []
+        for i in range(n):
             short_path = ntpath.basename(img_paths[i])  # get image path
             name = os.path.splitext(short_path)[0]
-            img_name = '%s_%s.%s' % (name, data_name, data_ext)
+            names.append('%s_%s.%s' % (name, data_name, data_ext))
+        return names
 
-            util.mkdir(self.opt.results_dir)
-            img_path = os.path.join(self.opt.results_dir, img_name)
-            img_numpy = util.tensor2im(save_data[i].data)
-            util.save_image(img_numpy, img_path)            
+    def save_results(self, save_data, data_name='none', data_ext='jpg'):
+        """Save the training or testing results to disk"""
+        if getattr(self.opt, 'no_save_results', False):
+            return
+        util.mkdir(self.opt.results_dir)
+        # progress is printed by test.py every manifest_freq batches, not per image
+        save_paths = [os.path.join(self.opt.results_dir, img_name)
+                      for img_name in self.get_result_names(save_data.size(0), data_name, data_ext)]
+
+        # the batch is converted to uint8 on the device and encoded in the background
+        self.get_result_writer().write(util.tensor2im_batch(save_data.data), save_paths)
+
+    def get_eval_batch(self):
+        """Return the result names, generated images and ground truth images of the last test batch"""
+        raise NotImplementedError('%s does not support evaluation during test' % self.name())
+
+    def supports_eval(self):
+        """Whether the model provides get_eval_batch for the --eval mode of test.py"""
+        return type(self).get_eval_batch is not BaseModel.get_eval_batch
+
+    def get_result_writer(self):
+        if getattr(self, 'result_writer', None) is None:
+            opt = self.opt
+            store = None
+            if getattr(opt, 'results_format', 'files') == 'shards':
+                store = ShardWriter(self.results_root, prefix='shard%d' % opt.shard_id, 
+                                    shard_size=opt.shard_size_mb * 1024**2)
+            self.result_writer = ResultWriter(getattr(opt, 'writer_threads', 4), getattr(opt, 'writer_queue', 64), 
+                                              getattr(opt, 'jpeg_quality', 95), getattr(opt, 'png_compress_level', 6), 
+                                              getattr(opt, 'webp_quality', 90), store, self.results_root)
+        return self.result_writer
+
+    def flush_results(self):
+        """Wait until all results are written to disk"""
+        if getattr(self, 'result_writer', None) is not None:
+            self.result_writer.flush()
+
+    def close_results(self):
+        """Write the pending results and release the writers at the end of a test run"""
+        if getattr(self, 'result_writer', None) is not None:
+            self.result_writer.close()
+            self.result_writer = None
 
     def save_feature_map(self, feature_map, save_path, name, add):
         if feature_map.dim() == 4:
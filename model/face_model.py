@@ -3,6 +3,7 @@ from model.base_model import BaseModel
 from model.networks import base_function, external_function
 import model.networks as network
 from util import task, util
+from util.video_sink import VideoSink
 import itertools
 import data as Dataset
 import numpy as np
@@ -11,8 +12,6 @@ import random
 import os
 import matplotlib.pyplot as plt
 from collections import OrderedDict
-import glob
-import cv2
 
 
 
@@ -44,6 +43,8 @@ class Face(BaseModel):
         parser.add_argument('--lambda_content', type=float, default=0.5, help='weight for the VGG19 content loss')
         parser.add_argument('--lambda_regularization', type=float, default=0.0025, help='weight for the affine regularization loss')
         parser.add_argument('--frames_D_V', type=int, default=3, help='number of frames of D_V')
+        parser.add_argument('--video_fps', type=int, default=15, help='frame rate of the generated test videos')
+        parser.add_argument('--no_vis_png', action='store_true', help='only encode the generated frames into the video, do *not* save them as png')
         
 
         parser.add_argument('--use_spect_g', action='store_false')
@@ -115,6 +116,7 @@ class Face(BaseModel):
             self.optimizers.append(self.optimizer_D)
         else:
             self.results_dir_base = self.opt.results_dir
+            self.video_sink = None
         self.setup(opt)
 
 
@@ -126,7 +128,8 @@ class Face(BaseModel):
         n_frames_load = opt.max_frames_per_gpu                        # number of total frames loaded into GPU at a time for each batch
         self.n_frames_load = min(n_frames_load, self.n_frames_total)
         
-        if self.isTrain:
+        if self.isTrain and data['seq_start'][0]:
+            # a new clip starts, its chunks are streamed by the following calls
             self.P_reference  = data['P'][:,:opt.image_nc, ...].cuda()
             self.BP_reference = data['BP'][:, :opt.structure_nc, ...].cuda()
             self.P_previous = None
@@ -138,40 +141,25 @@ class Face(BaseModel):
 
         if not self.isTrain:
             assert self.opt.batchSize == 1
-            if data['frame_idx'] == self.opt.start_frame + self.opt.n_frames_pre_load_test:
+            self.seq_end = bool(data['seq_end'][0])
+            if data['seq_start'][0]:
+                if self.video_sink is not None:
+                    # the previous sequence was not finished
+                    self.video_sink.close()
+                    self.video_sink = None
                 self.P_previous = None
                 self.BP_previous = None
+                self.reference_feature_list = None
                 self.P_reference  = data['P'][:,:opt.image_nc, ...].cuda()
                 self.BP_reference = data['BP'][:, :opt.structure_nc, ...].cuda()
-                print(self.opt.results_dir)
-                if data['change_seq']:
-                    self.write2video()
-            # else:
-            #     self.P_previous = self.test_generated
-            #     self.BP_previous = self.test_BP_previous
             self.opt.results_dir = os.path.join(self.results_dir_base,
                                                 self.image_paths[0].split('/')[-2])
            
 
-    def write2video(self):
-        images = sorted(glob.glob(self.opt.results_dir+'/*_vis.png'))
-        image_array=[]
-        for image in images:
-            image_rgb = cv2.imread(image)
-            image_array.append(image_rgb) 
-
-        out_name = self.opt.results_dir+'.avi' 
-        print('write video %s'%out_name)  
-        height, width, layers = image_rgb.shape
-        size = (width,height)
-        out = cv2.VideoWriter(out_name, cv2.VideoWriter_fourcc(*'DIVX'), 15, size)
- 
-        for i in range(len(image_array)):
-            out.write(image_array[i])
-        out.release()
-
-
-
+    def get_stream(self, latency_budget=None):
+        """Return a frame-by-frame streaming wrapper around the generator, see model/face_stream.py"""
+        from model.face_stream import FaceStream
+        return FaceStream(self.net_G, self.opt, latency_budget)
 
     def get_current_visuals(self):
         """Return visualization images"""
@@ -201,6 +189,20 @@ class Face(BaseModel):
 
 
 
+    def get_synthetic_input(self):
+        """Random first chunk of a training clip in the format of the face dataset"""
+        opt = self.opt
+        b, h, w = opt.batchSize, opt.load_size, opt.load_size
+        n_frames = min(opt.max_frames_per_gpu, opt.n_frames_total)
+        # edge and distance maps in [0,1], the last channel holds the labels of the face parts
+        BP = torch.rand(b, n_frames, opt.structure_nc, h, w)
+        BP[:, :, -1] = torch.randint(0, 7, (b, n_frames, h, w)).float()
+        return {'P': torch.rand(b, n_frames*opt.image_nc, h, w) * 2 - 1, 'BP': BP.view(b, -1, h, w),
+                'BP_path': ['synthetic%d' % n for n in range(b)],
+                'P_path': [['synthetic%d/%05d.png' % (n, i) for n in range(b)] for i in range(n_frames)],
+                'seq_start': torch.ones(b, dtype=torch.bool), 'seq_end': torch.zeros(b, dtype=torch.bool),
+                'frame_idx': torch.zeros(b, dtype=torch.long)}
+
     def test(self, save_features=False, save_all=False, generate_edge=True):
         """Forward function used in test time"""
         # img_gen, flow_fields, masks = self.net_G(self.input_P1, self.input_BP1, self.input_BP2)
@@ -209,22 +211,55 @@ class Face(BaseModel):
         n_frames_pre_load = self.opt.n_frames_pre_load_test
 
         self.BP_frame_step = self.BP_structures.view(-1, n_frames_pre_load, structure_nc, height, width).cuda()
+        if self.reference_feature_list is None:
+            # encode the reference once per sequence and reuse it for all the following chunks
+            net_G = self.net_G.module if isinstance(self.net_G, torch.nn.DataParallel) else self.net_G
+            self.reference_feature_list = net_G.source_reference(self.P_reference)
         self.test_generated, self.flow_fields, self.masks, _ = self.net_G(self.BP_frame_step, 
                                                                 self.P_reference, 
                                                                 self.BP_reference,
                                                                 self.P_previous,
-                                                                self.BP_previous)
+                                                                self.BP_previous,
+                                                                self.reference_feature_list)
         self.P_previous = self.test_generated[-1] 
         self.BP_previous = self.BP_frame_step[:,-1,... ]   
         
         self.test_generated = torch.cat(self.test_generated, 0)      
-        self.save_results(self.test_generated, data_name='vis', data_ext='png')
+        self.write_frames(self.test_generated)
 
         if generate_edge:
             value = self.BP_structures[:,0,...].unsqueeze(1)
             value = (1-value)*2-1
             self.save_results(value, data_name='edge', data_ext='png')
 
+        if self.seq_end:
+            self.video_sink.close()
+            self.video_sink = None
+
+    def get_eval_batch(self):
+        """The generated frames of the last chunk and the frames of the driving video"""
+        sequence = os.path.basename(self.opt.results_dir)
+        names = [os.path.join(sequence, os.path.splitext(os.path.basename(path))[0] + '_vis.png') for path in self.image_paths]
+        img_gt = self.P_images.view(-1, self.opt.image_nc, self.height, self.width)
+        return names, self.test_generated, img_gt
+
+    def write_frames(self, frames):
+        """Push the generated frames into the video of the current sequence"""
+        if self.video_sink is None:
+            self.video_sink = VideoSink(self.opt.results_dir+'.avi', fps=self.opt.video_fps)
+        images = util.tensor2im_batch(frames)
+        for i in range(frames.size(0)):
+            name = os.path.splitext(os.path.basename(self.image_paths[i]))[0]
+            image_path = None if self.opt.no_vis_png else os.path.join(self.opt.results_dir, name+'_vis.png')
+            self.video_sink.push(images[i], image_path)
+
+    def close_results(self):
+        # a run stopped in the middle of a sequence still gets a complete video of the generated frames
+        if self.video_sink is not None:
+            self.video_sink.close()
+            self.video_sink = None
+        BaseModel.close_results(self)
+
 
 
 
@@ -280,6 +315,12 @@ class Face(BaseModel):
 
         return D_loss
 
+    def temporal_difference(self, frames, i):
+        """Stack the differences of frames_D_V neighboring frames starting at frame i along the channels"""
+        window = frames[:, i:i+self.opt.frames_D_V]
+        diff = window[:, :-1] - window[:, 1:]
+        return diff.contiguous().view(diff.size(0), -1, diff.size(3), diff.size(4))
+
     def backward_D(self):
         """Calculate the GAN loss for the discriminators"""
         base_function._unfreeze(self.net_D)
@@ -290,60 +331,42 @@ class Face(BaseModel):
 
         base_function._unfreeze(self.net_D_V)
         i = np.random.randint(len(self.img_gen)-self.opt.frames_D_V+1)
-        # fake = [self.img_gen[i]]
-        # real = [self.P_frame_step[:,i,...]]
-        fake = []
-        real = []        
-        for frame in range(self.opt.frames_D_V-1):
-            fake.append(self.img_gen[i+frame]-self.img_gen[i+frame+1])
-            real.append(self.P_frame_step[:,i+frame,...]
-                       -self.P_frame_step[:,i+frame+1,...])
-        fake = torch.cat(fake, dim=1)
-        real = torch.cat(real, dim=1)
+        fake = self.temporal_difference(torch.stack(self.img_gen, 1), i)
+        real = self.temporal_difference(self.P_frame_step, i)
         self.loss_dis_img_gen_v = self.backward_D_basic(self.net_D_V, real, fake)
 
     def backward_G(self):
         """Calculate training loss for the generator"""
-        # gen_tensor = torch.cat([v.unsqueeze(1) for v in self.img_gen], 1)
-        loss_style_gen, loss_content_gen, loss_app_gen=0,0,0
-
-        for i in range(len(self.img_gen)):
-            gen = self.img_gen[i]
-            gt = self.P_frame_step[:,i,...]
-            loss_app_gen += self.L1loss(gen, gt)
-
-            content_gen, style_gen = self.Vggloss(gen, gt) 
-            loss_style_gen += style_gen
-            loss_content_gen += content_gen
-
-        self.loss_style_gen = loss_style_gen * self.opt.lambda_style
-        self.loss_content_gen = loss_content_gen * self.opt.lambda_content            
+        # all frames of the chunk are stacked along the batch dimension, the per-frame 
+        # mean losses are summed over frames as before, hence the n_frames factor
+        n_frames = len(self.img_gen)
+        _, _, c, h, w = self.P_frame_step.size()
+        gen = torch.cat(self.img_gen, 0)
+        gt = self.P_frame_step.transpose(0, 1).contiguous().view(-1, c, h, w)
+
+        loss_app_gen = self.L1loss(gen, gt) * n_frames
+        loss_content_gen, loss_style_gen = self.Vggloss(gen, gt) 
+        self.loss_style_gen = loss_style_gen * n_frames * self.opt.lambda_style
+        self.loss_content_gen = loss_content_gen * n_frames * self.opt.lambda_content            
         self.loss_app_gen = loss_app_gen * self.opt.lambda_rec
 
-
-
-        loss_correctness_p, loss_regularization_p=0, 0
-        loss_correctness_r, loss_regularization_r=0, 0
-
-        for i in range(len(self.flow_fields)):
-            flow_field_i = self.flow_fields[i]
-            flow_p, flow_r=[],[]
-            for j in range(0, len(flow_field_i), 2):
-                flow_p.append(flow_field_i[j])
-                flow_r.append(flow_field_i[j+1])
-
-            correctness_r = self.Correctness(self.P_frame_step[:,i,...], self.P_reference, 
-                                                    flow_r, self.opt.attn_layer)
-            correctness_p = self.Correctness(self.P_frame_step[:,i,...], self.P_previous_recoder[i].detach(), 
-                                                    flow_p, self.opt.attn_layer)
-            loss_correctness_p += correctness_p
-            loss_correctness_r += correctness_r
-            loss_regularization_p += self.Regularization(flow_p)
-            loss_regularization_r += self.Regularization(flow_r)
-
-
-        self.loss_correctness_p = loss_correctness_p * self.opt.lambda_correct     
-        self.loss_correctness_r = loss_correctness_r * self.opt.lambda_correct   
+        # flows of all frames for every attention layer, previous (p) and reference (r)
+        n_layers = len(self.flow_fields[0]) // 2
+        flow_p = [torch.cat([flow_field[2*j]   for flow_field in self.flow_fields], 0) for j in range(n_layers)]
+        flow_r = [torch.cat([flow_field[2*j+1] for flow_field in self.flow_fields], 0) for j in range(n_layers)]
+
+        # a single correctness pass for the reference and previous frames of all frames
+        P_previous = torch.cat([P.detach() for P in self.P_previous_recoder], 0)
+        P_reference = self.P_reference.repeat(n_frames, 1, 1, 1)
+        correctness = self.Correctness(torch.cat([gt, gt], 0), torch.cat([P_reference, P_previous], 0), 
+                                       [torch.cat([r, p], 0) for r, p in zip(flow_r, flow_p)], 
+                                       self.opt.attn_layer, reduce=False)
+        loss_correctness_r, loss_correctness_p = torch.split(correctness, gt.size(0))
+        loss_regularization_p = self.Regularization(flow_p) * n_frames
+        loss_regularization_r = self.Regularization(flow_r) * n_frames
+
+        self.loss_correctness_p = loss_correctness_p.mean() * n_frames * self.opt.lambda_correct     
+        self.loss_correctness_r = loss_correctness_r.mean() * n_frames * self.opt.lambda_correct   
         self.loss_regularization_p = loss_regularization_p * self.opt.lambda_regularization
         self.loss_regularization_r = loss_regularization_r * self.opt.lambda_regularization
 
@@ -358,11 +381,7 @@ class Face(BaseModel):
         ##########################################################################
         base_function._freeze(self.net_D_V)
         i = np.random.randint(len(self.img_gen)-self.opt.frames_D_V+1)
-        # fake = [self.img_gen[i]]
-        fake = []
-        for frame in range(self.opt.frames_D_V-1):
-            fake.append(self.img_gen[i+frame]-self.img_gen[i+frame+1])
-        fake = torch.cat(fake, dim=1)
+        fake = self.temporal_difference(torch.stack(self.img_gen, 1), i)
         D_fake = self.net_D_V(fake)
         self.loss_ad_gen_v = self.GANloss(D_fake, True, False) * self.opt.lambda_g
         ##########################################################################
@@ -0,0 +1,206 @@
+import time
+import argparse
+from collections import OrderedDict
+import numpy as np
+import torch
+from PIL import Image
+from data.face_dataset import FaceDataset
+from util import util
+
+
+class FaceStream():
+    """
+    Frame-by-frame face reenactment around a FaceGenerator.
+    The reference image is encoded once by set_reference, every call of step takes
+    the keypoints of one driving frame and returns the generated frame together with
+    the time spent in every stage. With a latency budget (in seconds) a frame whose
+    predicted latency exceeds the budget is not generated, the last frame is repeated.
+    After max_skipped repeated frames a frame is generated anyway, its measured time
+    replaces the prediction, so that one slow frame can not freeze the stream.
+    The stream only runs inference, net_G is put in eval mode by the constructor.
+    """
+    def __init__(self, net_G, opt, latency_budget=None, momentum=0.9, max_skipped=5):
+        self.net_G = net_G.module if isinstance(net_G, torch.nn.DataParallel) else net_G
+        self.net_G.eval()
+        self.device = next(self.net_G.parameters()).device
+        self.latency_budget = latency_budget
+        self.momentum = momentum
+        self.max_skipped = max_skipped
+
+        # the face maps are built exactly as for the test set
+        self.face_maps = FaceDataset()
+        self.face_maps.opt = opt
+        self.transform = self.face_maps.get_transform(opt)
+        self.reset()
+
+    def reset(self):
+        self.P_reference, self.BP_reference = None, None
+        self.reference_image, self.reference_feature_list = None, None
+        self.P_previous, self.BP_previous = None, None
+        self.last_frame = None
+        self.generator_time = None   # running average of the generator stages
+        self.n_frames, self.n_skipped = 0, 0
+        self.n_repeated = 0          # frames repeated since the last generated one
+
+    def sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def get_structure(self, keypoints, image=None):
+        """Face maps of one frame, the background edges are taken from the reference if no image is given"""
+        image = self.reference_image if image is None else image
+        face_maps = self.face_maps.get_face_maps(keypoints, self.size, image)
+        return self.face_maps.maps2tensor(face_maps).unsqueeze(0)
+
+    @torch.no_grad()
+    def set_reference(self, image, keypoints):
+        """Start a new stream from a reference image (PIL) and its keypoints"""
+        self.reset()
+        self.reference_image = image.convert('RGB')
+        self.size = self.reference_image.size
+        self.P_reference = self.transform(self.reference_image).unsqueeze(0).to(self.device)
+        self.BP_reference = self.get_structure(keypoints).to(self.device)
+        self.reference_feature_list = self.net_G.source_reference(self.P_reference)
+
+    @torch.no_grad()
+    def step(self, keypoints, image=None):
+        """Generate the frame of the given keypoints, return the uint8 image and the stage timings"""
+        assert self.P_reference is not None, 'call set_reference before streaming frames'
+        timing = OrderedDict()
+        start = time.perf_counter()
+        BP = self.get_structure(keypoints, image)
+        timing['maps'] = time.perf_counter() - start
+
+        if self.latency_budget is not None and self.last_frame is not None and self.generator_time is not None \
+           and timing['maps'] + self.generator_time > self.latency_budget and self.n_repeated < self.max_skipped:
+            # the frame cannot be generated in time, repeat the previous one
+            self.n_frames += 1
+            self.n_skipped += 1
+            self.n_repeated += 1
+            timing['total'] = time.perf_counter() - start
+            timing['skipped'] = True
+            return self.last_frame, timing
+
+        def stage(name, t):
+            self.sync()
+            now = time.perf_counter()
+            timing[name] = now - t
+            return now
+
+        t = time.perf_counter()
+        BP = BP.to(self.device)
+        P_previous = self.P_reference if self.P_previous is None else self.P_previous
+        BP_previous = self.BP_reference if self.BP_previous is None else self.BP_previous
+        t = stage('upload', t)
+
+        previous_feature_list = self.net_G.source_previous(P_previous)
+        t = stage('source', t)
+        flow_fields, masks = self.net_G.flow_net(BP, P_previous, BP_previous, self.P_reference, self.BP_reference)
+        t = stage('flow_net', t)
+        image_gen = self.net_G.target(BP, previous_feature_list, self.reference_feature_list, flow_fields, masks)
+        t = stage('target', t)
+        self.P_previous, self.BP_previous = image_gen, BP
+        self.last_frame = util.tensor2im_batch(image_gen)[0]
+        t = stage('download', t)
+
+        generator_time = sum(timing[name] for name in ['upload', 'source', 'flow_net', 'target', 'download'])
+        if self.generator_time is None or self.n_repeated > 0:
+            # the prediction that made the stream repeat frames is replaced by a fresh measurement
+            self.generator_time = generator_time
+        else:
+            self.generator_time = self.momentum * self.generator_time + (1 - self.momentum) * generator_time
+        self.n_repeated = 0
+        self.n_frames += 1
+        timing['total'] = time.perf_counter() - start
+        timing['skipped'] = False
+        return self.last_frame, timing
+
+
+def benchmark(stream, reference, keypoints, n_warmup=5):
+    """Stream all keypoint frames and report the sustained fps and the mean time of every stage"""
+    stream.set_reference(reference, keypoints[0])
+    for i in range(min(n_warmup, len(keypoints))):
+        stream.step(keypoints[i])
+    stream.set_reference(reference, keypoints[0])
+
+    timings = []
+    start = time.perf_counter()
+    for frame in keypoints:
+        _, timing = stream.step(frame)
+        timings.append(timing)
+    elapsed = time.perf_counter() - start
+
+    generated = [timing for timing in timings if not timing['skipped']]
+    stages = [name for name in generated[0] if name != 'skipped'] if len(generated) > 0 else []
+    print('streamed %d frames in %.2fs: %.2f fps, %d frames repeated'
+          % (len(timings), elapsed, len(timings) / elapsed, stream.n_skipped))
+    for name in stages:
+        values = np.array([timing[name] for timing in generated]) * 1000
+        print('%-10s mean %7.2f ms  max %7.2f ms' % (name, values.mean(), values.max()))
+    return len(timings) / elapsed
+
+
+def synthetic_keypoints(n_frames, size=256, seed=0):
+    """A 68 point face template with a slowly opening mouth and small head motion"""
+    rng = np.random.RandomState(seed)
+    c, r = size / 2.0, size / 4.0
+    jaw = [(c + r * np.cos(a), c + r * np.sin(a)) for a in np.linspace(np.pi, 0, 17)]
+    brows = [(c - r * 0.8 + r * 0.15 * i, c - r * 0.6 - r * 0.1 * np.sin(np.pi * i / 4)) for i in range(5)] + \
+            [(c + r * 0.2 + r * 0.15 * i, c - r * 0.6 - r * 0.1 * np.sin(np.pi * i / 4)) for i in range(5)]
+    nose = [(c, c - r * 0.4 + r * 0.12 * i) for i in range(4)] + [(c - r * 0.2 + r * 0.1 * i, c + r * 0.1) for i in range(5)]
+    eye = lambda x: [(x + r * 0.12 * np.cos(a), c - r * 0.3 + r * 0.06 * np.sin(a)) for a in np.linspace(np.pi, 3 * np.pi, 7)[:6]]
+    mouth = [(c + r * 0.4 * np.cos(a), c + r * 0.5 + r * 0.15 * np.sin(a)) for a in np.linspace(np.pi, 3 * np.pi, 13)[:12]] + \
+            [(c + r * 0.25 * np.cos(a), c + r * 0.5 + r * 0.05 * np.sin(a)) for a in np.linspace(np.pi, 3 * np.pi, 9)[:8]]
+    template = np.array(jaw + brows + nose + eye(c - r * 0.4) + eye(c + r * 0.4) + mouth, np.float32)
+
+    keypoints = []
+    for i in range(n_frames):
+        frame = template.copy()
+        frame[48:, 1] += (frame[48:, 1] - (c + r * 0.5)) * 0.5 * np.sin(i / 5.0)
+        frame += np.array([np.sin(i / 10.0), np.cos(i / 10.0)], np.float32) * 3 + rng.randn(*frame.shape) * 0.3
+        keypoints.append(frame)
+    return keypoints
+
+
+if __name__ == '__main__':
+    from model.networks.generator import FaceGenerator
+
+    parser = argparse.ArgumentParser(description='Benchmark frame-by-frame face reenactment on the cpu')
+    parser.add_argument('--checkpoint', type=str, default=None, help='path of a <iter>_net_G.pth, random weights if not given')
+    parser.add_argument('--reference', type=str, default=None, help='reference image, a blank image if not given')
+    parser.add_argument('--keypoints', type=str, default=None, help='(T,68,2) keypoints packed by data/pack_keypoints.py')
+    parser.add_argument('--n_frames', type=int, default=100)
+    parser.add_argument('--load_size', type=int, default=256)
+    parser.add_argument('--attn_layer', action=util.StoreList, metavar="VAL1,VAL2...", default=[2,3])
+    parser.add_argument('--kernel_size', action=util.StoreDictKeyPair, metavar="KEY1=VAL1,KEY2=VAL2...", default={'2':5, '3':3})
+    parser.add_argument('--layers', type=int, default=3)
+    parser.add_argument('--no_canny_edge', action='store_true')
+    parser.add_argument('--no_dist_map', action='store_true')
+    parser.add_argument('--latency_budget', type=float, default=None, help='latency budget of a frame in ms')
+    parser.add_argument('--threads', type=int, default=None, help='number of cpu threads used by torch')
+    opt = parser.parse_args()
+
+    if opt.threads is not None:
+        torch.set_num_threads(opt.threads)
+    structure_nc = 1 + (0 if opt.no_dist_map else 14) + 1
+    net_G = FaceGenerator(image_nc=3, structure_nc=structure_nc, ngf=64, img_f=512, layers=opt.layers, num_blocks=2,
+                          use_spect=False, attn_layer=opt.attn_layer, norm='instance', activation='LeakyReLU',
+                          extractor_kz=opt.kernel_size)
+    if opt.checkpoint is not None:
+        state_dict = torch.load(opt.checkpoint, map_location='cpu')
+        net_G.load_state_dict({k.replace('module.', ''): v for k, v in state_dict.items()})
+    else:
+        net_G.init_weights('orthogonal')
+
+    if opt.keypoints is not None:
+        keypoints = np.load(opt.keypoints, mmap_mode='r')[:opt.n_frames]
+    else:
+        keypoints = synthetic_keypoints(opt.n_frames, opt.load_size)
+    if opt.reference is not None:
+        reference = Image.open(opt.reference)
+    else:
+        reference = Image.new('RGB', (opt.load_size, opt.load_size), (128, 128, 128))
+
+    budget = None if opt.latency_budget is None else opt.latency_budget / 1000.0
+    stream = FaceStream(net_G, opt, latency_budget=budget)
+    benchmark(stream, reference, keypoints)
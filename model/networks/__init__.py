@@ -25,7 +25,8 @@ def create_network(cls, opt, **parameter_dic):
     if len(opt.gpu_ids) > 0:
         assert(torch.cuda.is_available())
         net.cuda()
-    net.init_weights(opt.init_type)
+    if not getattr(opt, 'skip_init', False):
+        net.init_weights(opt.init_type)
     return net
 
 
@@ -232,20 +232,20 @@ class PerceptualCorrectness(nn.Module):
         self.eps=1e-8 
         self.resample = Resample2d(4, 1, sigma=2)
 
-    def __call__(self, target, source, flow_list, used_layers, mask=None, use_bilinear_sampling=False):
+    def __call__(self, target, source, flow_list, used_layers, mask=None, use_bilinear_sampling=False, reduce=True):
         used_layers=sorted(used_layers, reverse=True)
         # self.target=target
         # self.source=source
         self.target_vgg, self.source_vgg = self.vgg(target), self.vgg(source)
         loss = 0
         for i in range(len(flow_list)):
-            loss += self.calculate_loss(flow_list[i], self.layer[used_layers[i]], mask, use_bilinear_sampling)
+            loss += self.calculate_loss(flow_list[i], self.layer[used_layers[i]], mask, use_bilinear_sampling, reduce)
 
 
 
         return loss
 
-    def calculate_loss(self, flow, layer, mask=None, use_bilinear_sampling=False):
+    def calculate_loss(self, flow, layer, mask=None, use_bilinear_sampling=False, reduce=True):
         target_vgg = self.target_vgg[layer]
         source_vgg = self.source_vgg[layer]
         [b, c, h, w] = target_vgg.shape
@@ -275,7 +275,10 @@ class PerceptualCorrectness(nn.Module):
 
         correction_sample = F.cosine_similarity(input_sample, target_all)    #[b 1 N2]
         loss_map = torch.exp(-correction_sample/(correction_max+self.eps))
-        if mask is None:
+        if mask is None and not reduce:
+            # one loss value for every sample of the batch
+            loss = torch.mean(loss_map, dim=1) - torch.exp(torch.tensor(-1).type_as(loss_map))
+        elif mask is None:
             loss = torch.mean(loss_map) - torch.exp(torch.tensor(-1).type_as(loss_map))
         else:
             mask=F.interpolate(mask, size=(target_vgg.size(2), target_vgg.size(3)))
@@ -3,6 +3,7 @@ import os
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.autograd.profiler import record_function
 from model.networks.base_network import BaseNetwork
 from model.networks.resample2d_package.resample2d import Resample2d
 from model.networks.base_function import *
@@ -53,10 +54,15 @@ class PoseGenerator(BaseNetwork):
 
 
     def forward(self, source, source_B, target_B, source_full, source_body_mask, target_mask, target_backgrand_mask):
-        feature_list = self.source(source)
-        source_backgrand = self.backgrand(source_full,masks=source_body_mask,only_x=True)
-        flow_fields, masks = self.flow_net(source, source_B, target_B)
-        image_gen = self.target(target_B, feature_list, flow_fields, masks)
+        # the labels name the submodules in torch.profiler traces (--profile)
+        with record_function('PoseGenerator.source'):
+            feature_list = self.source(source)
+        with record_function('PoseGenerator.backgrand'):
+            source_backgrand = self.backgrand(source_full,masks=source_body_mask,only_x=True)
+        with record_function('PoseGenerator.flow_net'):
+            flow_fields, masks = self.flow_net(source, source_B, target_B)
+        with record_function('PoseGenerator.target'):
+            image_gen = self.target(target_B, feature_list, flow_fields, masks)
         b,c,h,w = image_gen.size()
         gen = image_gen*target_mask
         gen = gen.view(3,-1,c,h,w)
@@ -311,9 +317,12 @@ class FaceGenerator(BaseNetwork):
                                     attn_layer=attn_layer, norm=norm, activation=activation,
                                     use_spect=use_spect, use_coord=use_coord)       
 
-    def forward(self, BP_frame_step, P_reference, BP_reference, P_previous, BP_previous):
+    def forward(self, BP_frame_step, P_reference, BP_reference, P_previous, BP_previous, reference_feature_list=None):
         n_frames_load = BP_frame_step.size(1)
         out_image_gen,out_flow_fields,out_masks,P_previous_recoder=[],[],[],[]
+        # the reference image is shared by all frames, encode it only once
+        if reference_feature_list is None:
+            reference_feature_list = self.source_reference(P_reference)
 
         for i in range(n_frames_load):
             # BP_previous = BP_frame_step[:, i, ...]
@@ -325,7 +334,6 @@ class FaceGenerator(BaseNetwork):
             P_previous_recoder.append(P_previous)
 
             previous_feature_list = self.source_previous(P_previous)
-            reference_feature_list = self.source_reference(P_reference)
 
             flow_fields, masks = self.flow_net(BP, P_previous, BP_previous, P_reference, BP_reference)
             image_gen = self.target(BP, previous_feature_list, reference_feature_list, flow_fields, masks)
@@ -1,4 +1,5 @@
 import torch
+from torch.autograd.profiler import record_function
 from model.base_model import BaseModel
 from model.networks import base_function, external_function
 import model.networks as network
@@ -141,9 +142,23 @@ class Pose(BaseModel):
             self.image_paths.append(os.path.splitext(input['P1_path'][i])[0] + '_2_' + input['P2_path'][i])
 
 
+    def get_synthetic_input(self):
+        """Random images, part masks and keypoints of the shapes of the fashion dataset"""
+        b, h, w = self.opt.batchSize, 256, 256
+        data = {}
+        for i in ['1', '2']:
+            data['P' + i] = torch.rand(b, 3, h, w) * 2 - 1
+            # blocks of part labels, the masks of the dataset are piecewise constant as well
+            labels = torch.randint(0, 20, (b, h // 16, w // 16), dtype=torch.uint8)
+            data['P%smasks' % i] = labels.repeat_interleave(16, 1).repeat_interleave(16, 2)
+            data['BP' + i] = torch.randint(0, 256, (b, 18, 2))
+            data['P%s_path' % i] = ['synthetic_%s_%d.jpg' % (i, n) for n in range(b)]
+        return data
+
     def test(self):
         """Forward function used in test time"""
         img_gen, flow_fields, masks = self.net_G(self.input_P1, self.input_BP1, self.input_BP2, self.input_fullP1, (1.0-self.input_P1backmask), self.input_P2mask ,self.input_P2backmask)
+        self.img_gen = img_gen
         self.save_results(img_gen, data_name='vis')
         if self.opt.save_input:
             self.save_results(self.input_P1, data_name='ref')
@@ -151,6 +166,10 @@ class Pose(BaseModel):
                        
                 
 
+    def get_eval_batch(self):
+        names = self.get_result_names(self.img_gen.size(0), data_name='vis', data_ext='jpg')
+        return names, self.img_gen, self.input_fullP2
+
     def forward(self):
         """Run forward processing to get the inputs"""
         self.img_gen, self.flow_fields, self.masks = self.net_G(self.input_P1, self.input_BP1, self.input_BP2, self.input_fullP1, (1.0-self.input_P1backmask), self.input_P2mask ,self.input_P2backmask)
@@ -158,20 +177,22 @@ class Pose(BaseModel):
 
     def backward_D_basic(self, netD, real, fake):
         """Calculate GAN loss for the discriminator"""
-        # Real
-        D_real = netD(real)
-        D_real_loss = self.GANloss(D_real, True, True)
-        # fake
-        D_fake = netD(fake.detach())
-        D_fake_loss = self.GANloss(D_fake, False, True)
-        # loss for discriminator
-        D_loss = (D_real_loss + D_fake_loss) * 0.5
-        # gradient penalty for wgan-gp
-        if self.opt.gan_mode == 'wgangp':
-            gradient_penalty, gradients = external_function.cal_gradient_penalty(netD, real, fake.detach())
-            D_loss += gradient_penalty
-
-        D_loss.backward()
+        with record_function('loss.dis'):
+            # Real
+            D_real = netD(real)
+            D_real_loss = self.GANloss(D_real, True, True)
+            # fake
+            D_fake = netD(fake.detach())
+            D_fake_loss = self.GANloss(D_fake, False, True)
+            # loss for discriminator
+            D_loss = (D_real_loss + D_fake_loss) * 0.5
+            # gradient penalty for wgan-gp
+            if self.opt.gan_mode == 'wgangp':
+                gradient_penalty, gradients = external_function.cal_gradient_penalty(netD, real, fake.detach())
+                D_loss += gradient_penalty
+
+        with record_function('backward.D'):
+            D_loss.backward()
 
         return D_loss
 
@@ -183,24 +204,29 @@ class Pose(BaseModel):
     def backward_G(self):
         """Calculate training loss for the generator"""
         # Calculate l1 loss 
-        loss_app_gen = self.L1loss(self.img_gen, self.input_fullP2)
+        with record_function('loss.app'):
+            loss_app_gen = self.L1loss(self.img_gen, self.input_fullP2)
         self.loss_app_gen = loss_app_gen * self.opt.lambda_rec
         
         # Calculate Sampling Correctness Loss        
-        loss_correctness_gen = self.Correctness(self.input_P2, self.input_P1, self.flow_fields, self.opt.attn_layer)
+        with record_function('loss.correctness'):
+            loss_correctness_gen = self.Correctness(self.input_P2, self.input_P1, self.flow_fields, self.opt.attn_layer)
         self.loss_correctness_gen = loss_correctness_gen * self.opt.lambda_correct        
 
         # Calculate GAN loss
         base_function._freeze(self.net_D)
-        D_fake = self.net_D(self.img_gen)
-        self.loss_ad_gen = self.GANloss(D_fake, True, False) * self.opt.lambda_g
+        with record_function('loss.ad_gen'):
+            D_fake = self.net_D(self.img_gen)
+            self.loss_ad_gen = self.GANloss(D_fake, True, False) * self.opt.lambda_g
 
         # Calculate regularization term 
-        loss_regularization = self.Regularization(self.flow_fields)
+        with record_function('loss.regularization'):
+            loss_regularization = self.Regularization(self.flow_fields)
         self.loss_regularization = loss_regularization * self.opt.lambda_regularization
 
         # Calculate perceptual loss
-        loss_content_gen, loss_style_gen = self.Vggloss(self.img_gen, self.input_fullP2) 
+        with record_function('loss.vgg'):
+            loss_content_gen, loss_style_gen = self.Vggloss(self.img_gen, self.input_fullP2) 
         self.loss_style_gen = loss_style_gen*self.opt.lambda_style
         self.loss_content_gen = loss_content_gen*self.opt.lambda_content
 
@@ -209,7 +235,8 @@ class Pose(BaseModel):
         for name in self.loss_names:
             if name != 'dis_img_gen':
                 total_loss += getattr(self, "loss_" + name)
-        total_loss.backward()
+        with record_function('backward.G'):
+            total_loss.backward()
 
 
     def optimize_parameters(self):
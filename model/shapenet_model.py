@@ -129,34 +129,63 @@ class ShapeNet(BaseModel):
         semantics = input_label.scatter_(1, label, 1.0)
         return semantics
 
-    def test(self):
-        """Forward function used in test time"""
-        for j, input_BP2 in enumerate(self.input_BP2):
-            input_BP2 = self.obtain_shape_net_semantic(input_BP2)
-            input_BP1 = self.obtain_shape_net_semantic(self.input_BP1)
-            img_gen, flow_fields, masks = self.net_G(self.input_P1, input_BP1, input_BP2)
-
-            for i in range(self.input_P1.size(0)):
-                util.mkdir(self.opt.results_dir)
-                img_path = os.path.join(self.opt.results_dir, self.image_paths[i])
-                util.mkdir(img_path)
-                source_name = os.path.join(img_path, 'source.png')
-                img_numpy = util.tensor2im(self.input_P1[i])
-                util.save_image(img_numpy, source_name) 
-
-                gt_name = os.path.join(img_path, 'gt_' + str(j).zfill(4) + '.png')
-                img_numpy = util.tensor2im(self.input_P2[j][i])
-                util.save_image(img_numpy, gt_name)                 
-
-                gen_name = os.path.join(img_path, 'result_' + str(j).zfill(4) + '.png')
-                img_numpy = util.tensor2im(img_gen[i])
-                util.save_image(img_numpy, gen_name) 
-                print(gen_name)                
-               
-
-
-            
+    def get_synthetic_input(self):
+        """Random views and viewpoints in the format of the shapenet dataset"""
+        b, h, w = self.opt.batchSize, self.opt.load_size, self.opt.load_size
+        data = {}
+        for i in ['1', '2']:
+            data['P' + i] = torch.rand(b, 3, h, w) * 2 - 1
+            # horizontal angle in steps of 20 degrees and vertical angle in steps of 10 degrees, both divided by 10
+            angle_h = torch.randint(0, self.opt.label_nc_h, (b,)) * 2
+            angle_v = torch.randint(0, self.opt.label_nc_v, (b,)) * 10
+            data['BP' + i] = torch.stack([angle_h, angle_v], 1).view(b, 2, 1, 1)
+            data['P%s_path' % i] = ['synthetic%d_%d_%d' % (n, angle_h[n], angle_v[n]) for n in range(b)]
+        return data
 
+    def test(self):
+        """Forward function used in test time, all target views of a source are rendered in one batch"""
+        n_views = len(self.input_BP2)
+        net_G = self.net_G.module if isinstance(self.net_G, torch.nn.DataParallel) else self.net_G
+
+        # views are stacked view-major: row j*batch_size+i is view j of sample i
+        input_BP1 = self.obtain_shape_net_semantic(self.input_BP1).repeat(n_views, 1, 1, 1)
+        input_BP2 = self.obtain_shape_net_semantic(torch.cat(self.input_BP2, 0))
+        input_P1 = self.input_P1.repeat(n_views, 1, 1, 1)
+
+        # the source is encoded once and its features are shared by all views
+        feature_list = [feature.repeat(n_views, 1, 1, 1) for feature in net_G.source(self.input_P1)]
+        flow_fields, masks = net_G.flow_net(input_P1, input_BP1, input_BP2)
+        self.img_gen = net_G.target(input_BP2, feature_list, flow_fields, masks)
+        self.img_gt = torch.cat(self.input_P2, 0)
+
+        self.save_views(self.img_gen, self.img_gt, n_views)
+
+    def get_eval_batch(self):
+        """All rendered views of the last batch, named like the written results"""
+        batch_size = self.input_P1.size(0)
+        n_views = self.img_gen.size(0) // batch_size
+        names = [os.path.join(self.image_paths[i], 'result_' + str(j).zfill(4) + '.png')
+                 for j in range(n_views) for i in range(batch_size)]
+        return names, self.img_gen, self.img_gt
+
+    def save_views(self, img_gen, input_P2, n_views):
+        """Write the source, ground truth and generated image of all views with one writer call"""
+        if getattr(self.opt, 'no_save_results', False):
+            return
+        batch_size = self.input_P1.size(0)
+        images = util.tensor2im_batch(torch.cat([self.input_P1, input_P2, img_gen], 0))
+
+        paths = []
+        for i in range(batch_size):
+            img_path = os.path.join(self.opt.results_dir, self.image_paths[i])
+            util.mkdir(img_path)
+            paths.append(os.path.join(img_path, 'source.png'))
+        for name in ['gt_', 'result_']:
+            for j in range(n_views):
+                for i in range(batch_size):
+                    img_path = os.path.join(self.opt.results_dir, self.image_paths[i])
+                    paths.append(os.path.join(img_path, name + str(j).zfill(4) + '.png'))
+        self.get_result_writer().write(images, paths)
 
     def forward(self):
         source_list=[]
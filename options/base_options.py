@@ -17,10 +17,12 @@ class BaseOptions():
         parser.add_argument('--name', type=str, default='experiment_name', help='name of the experiment.')
         parser.add_argument('--model', type=str, default='rec', help='name of the model type.')
         parser.add_argument('--checkpoints_dir', type=str, default='checkpoint', help='models are save here')
-        parser.add_argument('--which_iter', type=int, default=0, help='which iterations to load')
+        parser.add_argument('--which_iter', type=str, default='0', help='which iterations to load, an iteration or latest')
         parser.add_argument('--gpu_ids', type=str, default='0', help='gpu ids: e.g. 0, 1, 2 use -1 for CPU')
         parser.add_argument('--phase', type=str, default='train', help='train, val, test, etc')
         parser.add_argument('--continue_train', action='store_true', help='continue training: load the latest model')
+        parser.add_argument('--checkpoint_format', type=str, default='separate', choices=['separate', 'consolidated'], 
+                            help='save one file per network or a single memory-mappable file with all networks')
         parser.add_argument('--dataset_size',type=int,default=32000)
 
 
@@ -34,11 +36,21 @@ class BaseOptions():
         # for setting inputs
         parser.add_argument('--dataroot', type=str, default='./dataset/fashion/')
         parser.add_argument('--dataset_mode', type=str, default='fashion')
-        parser.add_argument('--fid_gt_path', type=str)
+        parser.add_argument('--fid_gt_path', type=str, default=None, help='cache of the ground truth inception statistics, a .npz file or a directory')
         parser.add_argument('--serial_batches', action='store_true', help='if true, takes images in order to make batches, otherwise takes them randomly')
         parser.add_argument('--nThreads', default=8, type=int, help='# threads for loading data')
         parser.add_argument('--max_dataset_size', type=int, default=sys.maxsize, help='Maximum number of samples allowed per dataset. If the dataset directory contains more than max_dataset_size, only a subset is loaded.')
 
+        # profiling, a window of wait/warmup/active iterations is captured repeat times
+        parser.add_argument('--profile', action='store_true', help='profile iterations with torch.profiler, written to <checkpoints_dir>/<name>/profile')
+        parser.add_argument('--profile_wait', type=int, default=5, help='# iterations skipped before a capture window')
+        parser.add_argument('--profile_warmup', type=int, default=2, help='# iterations traced but discarded in a capture window')
+        parser.add_argument('--profile_active', type=int, default=3, help='# iterations recorded in a capture window')
+        parser.add_argument('--profile_repeat', type=int, default=1, help='# capture windows, 0 repeats until the end of the run')
+        parser.add_argument('--profile_top_k', type=int, default=30, help='# operators of the written tables')
+        parser.add_argument('--profile_memory', action='store_true', help='record the tensor memory of the operators')
+        parser.add_argument('--profile_shapes', action='store_true', help='record the input shapes of the operators')
+
         # display parameter define
         parser.add_argument('--display_winsize', type=int, default=256, help='display window size')
         parser.add_argument('--display_id', type=int, default=1, help='display id of the web')
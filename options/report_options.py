@@ -0,0 +1,14 @@
+from .train_options import TrainOptions
+
+
+class ReportOptions(TrainOptions):
+    def initialize(self, parser):
+        parser = TrainOptions.initialize(self, parser)
+        parser.add_argument('--report_sort', type=str, default='peak_bytes', 
+                            choices=['peak_bytes', 'saved_bytes', 'param_bytes', 'flops', 'time'], help='column sorting the table')
+        parser.add_argument('--report_depth', type=int, default=3, help='deepest submodules listed in the table, the json has all')
+        parser.add_argument('--report_rows', type=int, default=60, help='# rows of the table, 0 for all')
+        parser.add_argument('--report_warmup', type=int, default=1, help='# training steps run before the measured one')
+        parser.add_argument('--report_dir', type=str, default=None, help='where to write the report, the checkpoint directory by default')
+
+        return parser
@@ -5,6 +5,22 @@ class TestOptions(BaseOptions):
     def initialize(self,  parser):
         parser = BaseOptions.initialize(self, parser)
         parser.add_argument('--results_dir', type=str, default='./results/', help='saves results here')
+        parser.add_argument('--writer_threads', type=int, default=4, help='# threads encoding the results, 0 to write them synchronously')
+        parser.add_argument('--writer_queue', type=int, default=64, help='maximum number of results waiting to be encoded')
+        parser.add_argument('--jpeg_quality', type=int, default=95, help='quality of jpg results')
+        parser.add_argument('--png_compress_level', type=int, default=6, help='zlib compression level of png results')
+        parser.add_argument('--webp_quality', type=int, default=90, help='quality of webp results')
+        parser.add_argument('--results_format', type=str, default='files', choices=['files', 'shards'], 
+                            help='write every result as a file or append them to large shard files with an index, see util/shard_store.py')
+        parser.add_argument('--shard_size_mb', type=int, default=1024, help='maximum size of a result shard file')
+        parser.add_argument('--inception_weights', type=str, default=None, help='local inception weights used for FID and IS, the pt_inception-2015-12-05 weights of pytorch-fid give the standard scores, see util/fid.py')
+        parser.add_argument('--eval', action='store_true', help='evaluate the generated images in memory while testing')
+        parser.add_argument('--eval_workers', type=int, default=2, help='# threads computing the metrics')
+        parser.add_argument('--no_save_results', action='store_true', help='do *not* write the generated images to disk')
+        parser.add_argument('--num_shards', type=int, default=1, help='split the test set into this number of shards')
+        parser.add_argument('--shard_id', type=int, default=0, help='the shard run by this process, in [0, num_shards)')
+        parser.add_argument('--resume', action='store_true', help='skip the items recorded in the manifests of results_dir')
+        parser.add_argument('--manifest_freq', type=int, default=50, help='frequency (in batches) of recording finished items in the manifest')
         parser.set_defaults(serial_batches=True)
         parser.set_defaults(phase='test')
         parser.set_defaults(batchSize=1)
@@ -9,6 +9,7 @@ class TrainOptions(BaseOptions):
         parser.add_argument('--iter_count', type=int, default=1, help='the starting epoch count')
         parser.add_argument('--niter', type=int, default=5000000, help='# of iter with initial learning rate')
         parser.add_argument('--niter_decay', type=int, default=0, help='# of iter to decay learning rate to zero')
+        parser.add_argument('--seed', type=int, default=0, help='seed of the training order, the order of an epoch is seed+epoch')
 
         # learning rate and loss weight
         parser.add_argument('--lr_policy', type=str, default='lambda', help='learning rate policy[lambda|step|plateau]')
@@ -19,9 +20,11 @@ class TrainOptions(BaseOptions):
         parser.add_argument('--display_freq', type=int, default=1000, help='frequency of showing training results on screen')
         parser.add_argument('--eval_iters_freq', type=int, default=15000, help='frequency of showing training results on screen')
         parser.add_argument('--print_freq', type=int, default=1000, help='frequency of showing training results on console')
-        parser.add_argument('--save_latest_freq', type=int, default=1000, help='frequency of saving the latest results')
-        parser.add_argument('--save_iters_freq', type=int, default=10000, help='frequency of saving checkpoints at the end of epochs')
+        parser.add_argument('--save_latest_freq', type=int, default=1000, help='frequency (iterations) of saving the latest checkpoint')
+        parser.add_argument('--save_iters_freq', type=int, default=10000, help='frequency (iterations) of saving a checkpoint named by the iteration')
         parser.add_argument('--no_html', action='store_true', help='do not save intermediate training results')
+        parser.add_argument('--time_phases', action='store_true', help='time the loader wait and the phases of every step (synchronizes cuda), log to step_timing.jsonl')
+        parser.add_argument('--timing_window', type=int, default=200, help='# of steps of the rolling timing percentiles')
 
         self.isTrain = True
 
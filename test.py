@@ -2,21 +2,80 @@ from options.test_options import TestOptions
 import data as Dataset
 from model import create_model
 from util import visualizer
+from util.test_manifest import ResultManifest
+from util.eval_pipeline import EvalPipeline, merge_reports
+from util.profiler import Profiler
+from util import util, fid
+import os
+import sys
 from itertools import islice
+from collections import OrderedDict
 import numpy as np
 import torch
+import time
+
+
+def select_indices(dataset, opt, done):
+    """Indices of the items run by this shard, groups whose items are all done are skipped"""
+    groups = OrderedDict()
+    for index in range(len(dataset)):
+        groups.setdefault(dataset.get_item_group(index), []).append(index)
+
+    indices, n_skipped = [], 0
+    for i, group in enumerate(groups.values()):
+        if i % opt.num_shards != opt.shard_id:
+            continue
+        if all(dataset.get_item_name(index) in done for index in group):
+            n_skipped += len(group)
+            continue
+        indices += group
+    return indices, n_skipped
+
+
+def create_eval_pipeline(opt, dataset, done=None):
+    """Metrics workers of the --eval mode, with FID and IS if inception weights are given"""
+    inception, gt_statistics = None, None
+    if opt.inception_weights is not None:
+        inception = fid.InceptionFeatures(opt.inception_weights).to(opt.device)
+        if opt.fid_gt_path is not None and not hasattr(dataset, 'name_pairs'):
+            print('the ground truth statistics need the pair list of the pose datasets, FID is not computed')
+        elif opt.fid_gt_path is not None:
+            gt_names = sorted(set(P2_name for _, P2_name in dataset.name_pairs))
+            gt_statistics = fid.get_gt_statistics(inception, dataset.image_dir, gt_names, opt.fid_gt_path, 
+                                                  opt.batchSize, opt.nThreads)
+    # the metrics of every shard are saved in parts next to its manifest, see merge_reports
+    state_dir = os.path.join(opt.results_dir, 'eval_%d_of_%d' % (opt.shard_id, opt.num_shards))
+    return EvalPipeline(state_dir, opt.eval_workers, inception=inception, done=done), gt_statistics
+
+
+def print_timing(n_items, stage_time, start):
+    elapsed = time.time() - start
+    print('%d items in %.1fs: %.2f items/s | %s' % (n_items, elapsed, n_items / max(elapsed, 1e-8),
+          ' '.join('%s %.3fs' % (name, value / max(n_items, 1)) for name, value in stage_time.items())))
+
 
 if __name__=='__main__':
     # get testing options
     opt = TestOptions().parse()
-    # creat a dataset
-    dataset = Dataset.create_dataloader(opt)
+    # creat a dataset, only the unfinished items of this shard are run
+    dataset = Dataset.create_dataset(opt)
+    manifest = ResultManifest(opt.results_dir, opt.shard_id, opt.num_shards)
+    done = manifest.load() if opt.resume else set()
+    indices, n_skipped = select_indices(dataset, opt, done)
+    item_names = [dataset.get_item_name(index) for index in indices]
+    dataloader = Dataset.create_dataloader(opt, dataset, indices)
+    results_dir = opt.results_dir
 
-    dataset_size = len(dataset) * opt.batchSize
-    print('testing images = %d' % dataset_size)
+    print('testing items = %d of shard %d/%d, %d items are already done'
+          % (len(indices), opt.shard_id, opt.num_shards, n_skipped))
     # create a model
     model = create_model(opt)
-    # model.eval()
+    model.set_model_to_eval_mode()
+    if opt.eval:
+        if not model.supports_eval():
+            sys.exit('model [%s] does not support --eval' % type(model).__name__)
+        eval_pipeline, gt_statistics = create_eval_pipeline(opt, dataset, done if opt.resume else None)
+    profiler = Profiler(opt, model.save_dir, 'test') if opt.profile else None
     # create a visualizer
     # visualizer = visualizer.Visualizer(opt)
 
@@ -24,10 +83,54 @@ if __name__=='__main__':
     #     model.set_input(data)
     #     model.test()
 
-    # for i, data in enumerate(islice(dataset, opt.how_many)):
-    with torch.no_grad():
-        for i, data in enumerate(dataset):
+    inference_mode = torch.inference_mode if hasattr(torch, 'inference_mode') else torch.no_grad
+    stage_time = OrderedDict([('data', 0.0), ('set_input', 0.0), ('test', 0.0), ('eval', 0.0), ('write', 0.0)])
+    n_items, start = 0, time.time()
+    with inference_mode():
+        t = time.time()
+        for i, data in enumerate(dataloader):
+            stage_time['data'] += time.time() - t
+            t = time.time()
             model.set_input(data)
+            stage_time['set_input'] += time.time() - t
+            t = time.time()
             model.test()
+            stage_time['test'] += time.time() - t
+            if opt.eval:
+                # hand the batch to the metrics workers without a disk round-trip
+                t = time.time()
+                names, img_gen, img_gt = model.get_eval_batch()
+                eval_pipeline.submit(names, util.tensor2im_batch(img_gt), util.tensor2im_batch(img_gen))
+                stage_time['eval'] += time.time() - t
 
+            # the test loader is serial and keeps the last partial batch
+            batch_size = min(opt.batchSize, len(item_names) - n_items)
+            manifest.add(item_names[n_items:n_items+batch_size])
+            if opt.eval:
+                eval_pipeline.add_items(item_names[n_items:n_items+batch_size])
+            n_items += batch_size
+            if profiler is not None:
+                profiler.step()
+            if (i + 1) % opt.manifest_freq == 0:
+                t = time.time()
+                model.flush_results()
+                if opt.eval:
+                    # the metrics are saved before their items are recorded as done
+                    eval_pipeline.checkpoint()
+                manifest.commit()
+                stage_time['write'] += time.time() - t
+                print_timing(n_items, stage_time, start)
+            t = time.time()
 
+    if profiler is not None:
+        profiler.stop()
+    t = time.time()
+    model.close_results()
+    if opt.eval:
+        eval_pipeline.close()
+    manifest.commit()
+    stage_time['write'] += time.time() - t
+    print_timing(n_items, stage_time, start)
+    if opt.eval:
+        # the report covers all shards and runs finished so far, util/eval_pipeline.py merges them again later
+        merge_reports(results_dir, os.path.join(results_dir, 'eval'), gt_statistics)
@@ -1,17 +1,32 @@
 import time
+import signal
 from options.train_options import TrainOptions
 import data as Dataset
 from model import create_model
 import util.util as util
+from util.step_timer import StepTimer
+from util.profiler import Profiler
+import os
 # from util.visualizer import Visualizer
-full_time = 9*3600
-max_epoch_time = 0
+
+
+class StopSignal():
+    """Remember a SIGTERM (e.g. preemption of the job), the loop then saves a checkpoint and exits"""
+    def __init__(self):
+        self.received = False
+        signal.signal(signal.SIGTERM, self.handle)
+
+    def handle(self, signum, frame):
+        print('\n received signal %d, save the latest checkpoint and stop' % signum)
+        self.received = True
+
 
 if __name__ == '__main__':
     # get training options
     opt = TrainOptions().parse()
     # create a dataset
     dataset = Dataset.create_dataloader(opt)
+    sampler = dataset.batch_sampler
     dataset_size = len(dataset) * opt.batchSize
     print('training images = %d' % dataset_size)
     # create a model
@@ -22,23 +37,49 @@ if __name__ == '__main__':
     # training flag
     keep_training = True
     max_iteration = opt.niter+opt.niter_decay
-    epoch = opt.which_iter
-    total_iteration = opt.iter_count
+    # epoch counts the finished epochs, epoch_iter the batches already trained of the next one.
+    # total_iteration counts the trained clips when the dataset streams them chunk by chunk
+    epoch = model.train_state.get('epoch', int(opt.which_iter) if opt.which_iter.isdigit() else 0)
+    total_iteration = model.train_state.get('iteration', opt.iter_count)
+    epoch_iter = model.train_state.get('epoch_iter', 0)
+    stop_signal = StopSignal()
+    timer = None
+    if opt.time_phases:
+        timer = StepTimer(os.path.join(model.save_dir, 'step_timing.jsonl'), opt.timing_window)
+        timer.wrap(model, ['set_input', 'forward', 'backward_D', 'backward_G', 'optimize_parameters'])
+    profiler = Profiler(opt, model.save_dir, 'train') if opt.profile else None
 
     # training process
     while(keep_training):
         epoch_start_time = time.time()
         epoch+=1
+        # a clip can not be resumed in the middle, its first chunks are trained again.
+        # they were not counted in total_iteration, which is only increased by the last chunk
+        epoch_iter = sampler.set_epoch(epoch, epoch_iter)
+        # the length of an epoch is fixed by set_epoch, the clip sampler draws all clips to count it
+        epoch_len = len(sampler)
         print('\n Training epoch: %d' % epoch)
+        if epoch_iter > 0:
+            print('resume epoch %d at batch %d' % (epoch, epoch_iter))
 
+        data_start_time = time.time()
         for i, data in enumerate(dataset):
             iter_start_time = time.time()
-            total_iteration += 1
+            # an iteration trains a whole clip, as before the clips were streamed chunk by chunk, 
+            # so that niter and the frequencies keep their units
+            iteration_done = 'seq_end' not in data or bool(data['seq_end'][0])
+            total_iteration += int(iteration_done)
+            epoch_iter += 1
             model.set_input(data)
             model.optimize_parameters()
+            if timer is not None:
+                timer.end_step(total_iteration, iter_start_time - data_start_time)
+            if profiler is not None:
+                profiler.step()
+            train_state = {'epoch': epoch-1, 'iteration': total_iteration, 'epoch_iter': epoch_iter}
 
             # display images on visdom and save images
-            if total_iteration % opt.display_freq == 0:
+            if iteration_done and total_iteration % opt.display_freq == 0:
                 vis = model.get_current_visuals()
                 for img_key in vis.keys():
                     util.save_image(vis[img_key],'{}/{}.jpg'.format('result/vis',img_key+str(total_iteration)))
@@ -46,14 +87,27 @@ if __name__ == '__main__':
                     visualizer.plot_current_distribution(model.get_current_dis()) 
 
             # print training loss and save logging information to the disk
-            if total_iteration % opt.print_freq == 0:
+            if iteration_done and total_iteration % opt.print_freq == 0:
                 losses = model.get_current_errors()
                 t = (time.time() - iter_start_time) / opt.batchSize
                 loss = ''
                 for k in losses.keys():
                     loss = loss + k + str(losses[k])
                 print('epoch={},total={},loss={},time={}'.format(epoch, total_iteration, loss, t))
+                if timer is not None:
+                    timer.summary(total_iteration)
 
+            # checkpoints of the latest iteration and periodic ones named by the iteration
+            if iteration_done and total_iteration % opt.save_iters_freq == 0:
+                model.save_networks(total_iteration, train_state)
+            keep_training = total_iteration < max_iteration and not stop_signal.received
+            # the last batch of an epoch is saved as 'latest' by the end of the epoch
+            end_of_epoch = epoch_iter == epoch_len
+            if (iteration_done and total_iteration % opt.save_latest_freq == 0 and not end_of_epoch) or not keep_training:
+                model.save_networks('latest', train_state)
+            if not keep_training:
+                break
+            data_start_time = time.time()
 
         #     if total_iteration % opt.eval_iters_freq == 0:
         #         model.eval() 
@@ -64,12 +118,16 @@ if __name__ == '__main__':
         #                 visualizer.plot_current_score(total_iteration, eval_results)
                     
 
-        epoch_time = time.time() - epoch_start_time
-        full_time -= epoch_time
-        if epoch_time > max_epoch_time:
-            max_epoch_time = epoch_time
-        if full_time < max_epoch_time:
-            keep_training = False
+        if not keep_training:
+            break
+        print('epoch %d finished in %.1fs' % (epoch, time.time() - epoch_start_time))
+        epoch_iter = 0
         model.save_networks(epoch)
         model.update_learning_rate()
+        model.save_networks('latest', {'epoch': epoch, 'iteration': total_iteration, 'epoch_iter': 0})
+    model.wait_for_checkpoint()
+    if timer is not None:
+        timer.close()
+    if profiler is not None:
+        profiler.stop()
     print('\nEnd training')
@@ -0,0 +1,101 @@
+import os
+import glob
+import threading
+import torch
+from util import util
+
+
+class CheckpointWriter():
+    """
+    Write checkpoints on a background thread.
+    The state dicts are first copied into host buffers (pinned and reused between
+    checkpoints when cuda is used), so training continues as soon as the copies are
+    issued. Every file is written to a temporary name and renamed when complete.
+    Only one checkpoint is in flight, a new one waits for the previous write.
+    """
+    def __init__(self):
+        self.buffers = {}
+        self.thread = None
+        self.error = None
+
+    def snapshot(self, value, key=''):
+        """Copy all tensors of a nested state into host buffers"""
+        if torch.is_tensor(value):
+            if value.is_cuda:
+                buffer = self.buffers.get(key)
+                if buffer is None or buffer.size() != value.size() or buffer.dtype != value.dtype:
+                    buffer = torch.empty(value.size(), dtype=value.dtype, pin_memory=True)
+                    self.buffers[key] = buffer
+                buffer.copy_(value.detach(), non_blocking=True)
+                return buffer
+            return value.detach().clone()
+        if isinstance(value, dict):
+            result = type(value)((k, self.snapshot(v, key + '/' + str(k))) for k, v in value.items())
+            if hasattr(value, '_metadata'):
+                # the version information of module state dicts
+                result._metadata = value._metadata
+            return result
+        if isinstance(value, (list, tuple)):
+            return type(value)(self.snapshot(v, key + '/' + str(i)) for i, v in enumerate(value))
+        return value
+
+    def save(self, files):
+        """Save a list of (key, path, state) in the background, the key identifies the reused buffers"""
+        self.wait()
+        snapshots = [(path, self.snapshot(state, key)) for key, path, state in files]
+        event = None
+        if torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()
+        self.thread = threading.Thread(target=self.write, args=(snapshots, event))
+        self.thread.start()
+
+    def write(self, snapshots, event):
+        try:
+            if event is not None:
+                event.synchronize()
+            for path, state in snapshots:
+                tmp_path = path + '.tmp'
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """Block until the last checkpoint is on disk"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def consolidate(save_dir, which_iter):
+    """Merge the <iter>_net_<name>.pth files of an iteration into a single <iter>_nets.pth"""
+    prefix = '%s_net_' % which_iter
+    nets = {}
+    for path in sorted(glob.glob(os.path.join(save_dir, prefix + '*.pth'))):
+        name = os.path.basename(path)[len(prefix):-len('.pth')]
+        nets['net_' + name] = torch.load(path, map_location='cpu')
+    # the iteration is kept with the networks, 'latest' does not name it
+    state_path = os.path.join(save_dir, '%s_train_state.pth' % which_iter)
+    if os.path.isfile(state_path):
+        nets['iteration'] = torch.load(state_path, map_location='cpu')['iteration']
+    elif len(nets) > 0:
+        name = sorted(nets.keys())[0][len('net_'):]
+        nets['iteration'] = util.get_iteration(save_dir, prefix + name + '.pth', name)
+    path = os.path.join(save_dir, '%s_nets.pth' % which_iter)
+    torch.save(nets, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    print('write %s with %s' % (path, ', '.join(sorted(key for key in nets.keys() if key.startswith('net_')))))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Merge the network files of a checkpoint into one memory-mappable file')
+    parser.add_argument('--checkpoints_dir', type=str, default='checkpoint')
+    parser.add_argument('--name', type=str, required=True)
+    parser.add_argument('--which_iter', type=str, default='latest')
+    args = parser.parse_args()
+    consolidate(os.path.join(args.checkpoints_dir, args.name), args.which_iter)
@@ -0,0 +1,195 @@
+import os
+import glob
+import queue
+import threading
+import numpy as np
+from util.evaluation import MetricsReport, compute_metrics
+from util.fid import FeatureStatistics, frechet_distance, score_names
+from util.test_manifest import ResultManifest
+
+
+class EvalPipeline():
+    """
+    Evaluate generated batches in memory while the next batches are generated.
+    Batches are uint8 (N,H,W,C) arrays of the generated and ground truth images, a pool
+    of threads computes L1/PSNR/SSIM/TV and, with an inception network, the FID/IS features.
+    The per image metrics and features are saved by checkpoint() in numbered parts under
+    state_dir together with the names of the test items they belong to. test.py saves a part
+    before it records these items in its manifest, a part is valid once all its items are
+    recorded. The reports are merged from the valid parts of all shards and runs by merge_reports.
+    """
+    def __init__(self, state_dir, n_workers=2, max_queue=8, inception=None, done=None):
+        self.state_dir = state_dir
+        self.inception = inception
+        self.lock = threading.Lock()
+        self.inception_lock = threading.Lock()
+        self.error = None
+        self.reset()
+        self.n_parts = self.init_parts(done)
+        self.queue = queue.Queue(max_queue)
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(n_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def reset(self):
+        self.items, self.names, self.metrics, self.features, self.probs = [], [], {}, [], []
+
+    def init_parts(self, done=None):
+        """
+        Keep the valid parts of the previous runs when resuming with the done items of the manifests,
+        a new run starts without parts. Return the number of the next part.
+        """
+        n_parts = 0
+        for path in sorted(glob.glob(os.path.join(self.state_dir, 'part_*.npz'))):
+            if done is None or not set(np.load(path)['items'].tolist()) <= done:
+                os.remove(path)
+            else:
+                n_parts = int(os.path.basename(path)[len('part_'):-len('.npz')]) + 1
+        return n_parts
+
+    def add_items(self, items):
+        """Names of the test items whose batches were submitted since the last part"""
+        self.items += list(items)
+
+    def submit(self, names, gts, pres):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((names, gts, pres))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            if self.error is None:
+                try:
+                    self.evaluate(*item)
+                except Exception as e:
+                    self.error = e
+            self.queue.task_done()
+
+    def evaluate(self, names, gts, pres):
+        metrics = compute_metrics(gts, pres)
+        features = None
+        if self.inception is not None:
+            with self.inception_lock:
+                features, logits = self.inception(pres)
+            probs = logits.detach().float().softmax(1).cpu().numpy()
+            features = features.detach().float().cpu().numpy()
+        with self.lock:
+            self.names += list(names)
+            for key, value in metrics.items():
+                self.metrics.setdefault(key, []).append(value.detach().cpu().double().numpy())
+            if features is not None:
+                self.features.append(features)
+                self.probs.append(probs)
+
+    def checkpoint(self):
+        """Wait for the submitted batches and save their metrics and features as a new part"""
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+        if len(self.items) == 0:
+            return
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        state = {'items': np.array(self.items), 'names': np.array(self.names)}
+        for key, value in self.metrics.items():
+            state['metric_' + key] = np.concatenate(value)
+        if len(self.features) > 0:
+            state['features'] = np.concatenate(self.features)
+            state['probs'] = np.concatenate(self.probs)
+            state['backbone'] = self.inception.backbone
+        path = os.path.join(self.state_dir, 'part_%05d.npz' % self.n_parts)
+        np.savez(path + '.tmp.npz', **state)
+        os.replace(path + '.tmp.npz', path)
+        self.n_parts += 1
+        self.reset()
+
+    def close(self):
+        """Save the last part and stop the workers"""
+        self.checkpoint()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def merge_reports(results_dir, report_dir, gt_statistics=None, gt_backbone=None):
+    """
+    Write the report of the evaluation parts of all shards (results_dir/eval_<shard>_of_<n>).
+    Only the parts whose items are recorded in the manifests are counted, an image evaluated
+    again by a resumed run is taken from its latest part. FID is computed against gt_statistics,
+    FID and IS are named after the inception backbone unless it is the standard one of fid.py.
+    """
+    done = ResultManifest(results_dir).load()
+    images, backbones = {}, set()
+    for state_dir in sorted(glob.glob(os.path.join(results_dir, 'eval_*_of_*'))):
+        for path in sorted(glob.glob(os.path.join(state_dir, 'part_*.npz'))):
+            part = np.load(path)
+            if not set(part['items'].tolist()) <= done:
+                continue
+            keys = [key for key in part.files if key.startswith('metric_')]
+            has_features = 'features' in part.files
+            if has_features:
+                backbones.add(str(part['backbone']) if 'backbone' in part.files else 'torchvision')
+            for i, name in enumerate(part['names'].tolist()):
+                images[name] = (dict((key[len('metric_'):], part[key][i]) for key in keys),
+                                (part['features'][i], part['probs'][i]) if has_features else None)
+
+    report = MetricsReport()
+    stats = None
+    names = sorted(images.keys())
+    if len(names) > 0:
+        keys = list(images[names[0]][0].keys())
+        report.add(names, dict((key, np.array([images[name][0][key] for name in names])) for key in keys))
+        with_features = [images[name][1] for name in names if images[name][1] is not None]
+        if len(with_features) > 0:
+            features = np.stack([f for f, _ in with_features])
+            stats = FeatureStatistics(features.shape[1])
+            stats.add_arrays(features, np.stack([p for _, p in with_features]))
+
+    extra = {}
+    if len(backbones) > 1:
+        print('the parts were evaluated with the inception backbones %s, FID and IS are not computed' % sorted(backbones))
+    elif stats is not None and stats.n > 1:
+        backbone = backbones.pop()
+        fid_name, is_name = score_names(backbone)
+        is_mean, is_std = stats.inception_score()
+        extra.update({'inception': backbone, is_name: is_mean, is_name + '_std': is_std})
+        if gt_backbone is not None and gt_backbone != backbone:
+            print('the ground truth statistics use the %s backbone, FID is not computed' % gt_backbone)
+        elif gt_statistics is not None:
+            mu, sigma = stats.mean_cov()
+            extra[fid_name] = frechet_distance(mu, sigma, gt_statistics[0], gt_statistics[1])
+    aggregate = report.write(report_dir, extra)
+    print(' '.join('%s: %.4f' % (key, value) for key, value in aggregate.items() if key != 'inception'))
+    return aggregate
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Merge the in-memory evaluation of all shards and resumed runs of test.py')
+    parser.add_argument('--results_dir', type=str, required=True)
+    parser.add_argument('--report_dir', type=str, default=None, help='where to write the merged report, results_dir/eval by default')
+    parser.add_argument('--fid_gt_path', type=str, default=None, 
+                        help='the --fid_gt_path of test.py, a .npz file or a directory holding one fid_stats_<hash>.npz')
+    args = parser.parse_args()
+
+    gt_statistics, gt_backbone = None, None
+    if args.fid_gt_path is not None:
+        cache_path = args.fid_gt_path
+        if os.path.isdir(cache_path):
+            # the hash is taken over the ground truth file list, which is not known here
+            candidates = sorted(glob.glob(os.path.join(cache_path, 'fid_stats_*.npz')))
+            if len(candidates) != 1:
+                parser.error('%s holds %d ground truth statistics, pass the .npz file of the test set' 
+                             % (cache_path, len(candidates)))
+            cache_path = candidates[0]
+        cache = np.load(cache_path)
+        gt_statistics = (cache['mu'], cache['sigma'])
+        # the statistics cached before the backbone was recorded are the torchvision ones
+        gt_backbone = str(cache['backbone']) if 'backbone' in cache.files else 'torchvision'
+    report_dir = os.path.join(args.results_dir, 'eval') if args.report_dir is None else args.report_dir
+    merge_reports(args.results_dir, report_dir, gt_statistics, gt_backbone)
@@ -1,108 +1,167 @@
-import numpy as np
+import os
+import csv
+import json
+import time
+import math
 import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
 from PIL import Image
-import math
-from dataloader.image_folder import make_dataset
-import os
-import glob
-import shutil
-
-parser = argparse.ArgumentParser(description='Evaluation ont the dataset')
-parser.add_argument('--gt_path', type = str, default='/media/lyndon/c6f4bbbd-8d47-4dcb-b0db-d788fe2b2557/dataset/image_painting/imagenet_test.txt',
-                    help = 'path to original particular solutions')
-parser.add_argument('--save_path', type = str, default='/media/lyndon/c6f4bbbd-8d47-4dcb-b0db-d788fe2b2557/dataset/image_painting/results/ours/imagenet/center',
-                    help='path to save the test dataset')
-parser.add_argument('--num_test', type=int, default=1000,
-                    help='how many images to load for each test')
-# parser.add_argument('--sample_numbers',type=int,default=50, help='how many smaple images for testing')
-args = parser.parse_args()
-
-
-def compute_errors(gt, pre):
-
-    # l1 loss
-    l1 = np.mean(np.abs(gt-pre))
-
-    # PSNR
-    mse = np.mean((gt - pre) ** 2)
-    if mse == 0:
-        PSNR = 100
-    else:
-        PSNR = 20 * math.log10(255.0 / math.sqrt(mse))
-
-    # TV
-    gx = pre - np.roll(pre, -1, axis=1)
-    gy = pre - np.roll(pre, -1, axis=0)
-    grad_norm2 = gx ** 2 + gy ** 2
-    TV = np.mean(np.sqrt(grad_norm2))
-
-    return l1, PSNR, TV
+from util.shard_store import open_results
+
+
+def get_pairs(pair_file, data_name='vis', data_ext='jpg'):
+    """
+    Read the pair csv of the test set and return (result name, ground truth name) tuples.
+    The result names follow BaseModel.save_results: <from>_2_<to>_<data_name>.<data_ext>
+    """
+    pairs = pd.read_csv(pair_file)
+    names = []
+    for P1_name, P2_name in zip(pairs['from'], pairs['to']):
+        result_name = os.path.splitext(os.path.splitext(P1_name)[0] + '_2_' + P2_name)[0]
+        names.append(('%s_%s.%s' % (result_name, data_name, data_ext), P2_name))
+    return names
+
+
+def gaussian_window(window_size=11, sigma=1.5):
+    coords = torch.arange(window_size, dtype=torch.float32) - window_size // 2
+    g = torch.exp(-coords ** 2 / (2 * sigma ** 2))
+    g = g / g.sum()
+    return g[:, None] * g[None, :]
+
+
+def ssim(gt, pre, window_size=11, sigma=1.5, data_range=255.0):
+    """Per image SSIM of two (N,C,H,W) float batches with a gaussian window, averaged over the channels"""
+    c = gt.size(1)
+    window = gaussian_window(window_size, sigma).to(gt)[None, None].repeat(c, 1, 1, 1)
+    C1, C2 = (0.01 * data_range) ** 2, (0.03 * data_range) ** 2
+    mu_x = F.conv2d(gt, window, groups=c)
+    mu_y = F.conv2d(pre, window, groups=c)
+    sigma_xx = F.conv2d(gt * gt, window, groups=c) - mu_x ** 2
+    sigma_yy = F.conv2d(pre * pre, window, groups=c) - mu_y ** 2
+    sigma_xy = F.conv2d(gt * pre, window, groups=c) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + C1) * (2 * sigma_xy + C2)) / ((mu_x ** 2 + mu_y ** 2 + C1) * (sigma_xx + sigma_yy + C2))
+    return ssim_map.mean(dim=(1, 2, 3))
+
+
+def compute_metrics(gt, pre):
+    """
+    L1, PSNR, SSIM and TV of every image of two uint8 (N,H,W,C) batches, computed with batched
+    tensor operations on the device of the inputs. Returns a dict of (N,) tensors.
+    """
+    gt = torch.as_tensor(gt).permute(0, 3, 1, 2).float()
+    pre = torch.as_tensor(pre).permute(0, 3, 1, 2).float()
+
+    l1 = (gt - pre).abs().mean(dim=(1, 2, 3))
+    mse = ((gt - pre) ** 2).mean(dim=(1, 2, 3))
+    psnr = 20 * torch.log10(255.0 / mse.clamp(min=1e-10).sqrt())
+    psnr[mse == 0] = 100
+
+    gx = pre - torch.roll(pre, -1, dims=3)
+    gy = pre - torch.roll(pre, -1, dims=2)
+    tv = torch.sqrt(gx ** 2 + gy ** 2).mean(dim=(1, 2, 3))
+
+    return {'l1': l1, 'psnr': psnr, 'ssim': ssim(gt, pre), 'tv': tv}
+
+
+class MetricsReport():
+    """Collect the per image metrics and write the per image csv and the aggregate json reports"""
+    def __init__(self):
+        self.names = []
+        self.values = {}
+
+    def add(self, names, metrics):
+        self.names += list(names)
+        for key, value in metrics.items():
+            value = value.detach().cpu().double().numpy() if torch.is_tensor(value) else np.asarray(value, np.float64)
+            self.values.setdefault(key, []).append(value)
+
+    def aggregate(self):
+        return dict((key, float(np.concatenate(value).mean())) for key, value in self.values.items())
+
+    def write(self, report_dir, extra=None):
+        if not os.path.isdir(report_dir):
+            os.makedirs(report_dir)
+        keys = list(self.values.keys())
+        columns = [np.concatenate(self.values[key]) for key in keys]
+        with open(os.path.join(report_dir, 'metrics_per_image.csv'), 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['name'] + keys)
+            for i, name in enumerate(self.names):
+                writer.writerow([name] + ['%.6f' % column[i] for column in columns])
+
+        aggregate = self.aggregate()
+        aggregate['n_images'] = len(self.names)
+        if extra is not None:
+            aggregate.update(extra)
+        with open(os.path.join(report_dir, 'metrics.json'), 'w') as f:
+            json.dump(aggregate, f, indent=2)
+        return aggregate
+
+
+_reader = None
+_gt_dir = None
+
+def _init_loader(results_dir, gt_dir):
+    # every worker opens its own reader, memory maps are not shared across processes
+    global _reader, _gt_dir
+    _reader = open_results(results_dir)
+    _gt_dir = gt_dir
+
+def _load_batch(pairs):
+    gts, pres, names = [], [], []
+    for result_name, gt_name in pairs:
+        if result_name not in _reader:
+            continue
+        pre = Image.fromarray(_reader.read_image(result_name)).convert('RGB')
+        gt = Image.open(os.path.join(_gt_dir, gt_name)).convert('RGB')
+        if gt.size != pre.size:
+            gt = gt.resize(pre.size, Image.BICUBIC)
+        gts.append(np.asarray(gt))
+        pres.append(np.asarray(pre))
+        names.append(result_name)
+    if len(names) == 0:
+        return names, None, None
+    return names, np.stack(gts), np.stack(pres)
+
+
+def evaluate(results_dir, gt_dir, pairs, report_dir, n_workers=8, batch_size=64):
+    """Evaluate the results of all pairs, the images are decoded by a pool of processes"""
+    batches = [pairs[i:i+batch_size] for i in range(0, len(pairs), batch_size)]
+    report = MetricsReport()
+    start = time.time()
+    with multiprocessing.Pool(n_workers, initializer=_init_loader, initargs=(results_dir, gt_dir)) as pool:
+        for names, gts, pres in pool.imap(_load_batch, batches):
+            if len(names) > 0:
+                report.add(names, compute_metrics(gts, pres))
+    elapsed = time.time() - start
+
+    n_images = len(report.names)
+    aggregate = report.write(report_dir, {'n_missing': len(pairs) - n_images, 'seconds': elapsed})
+    print('evaluated %d images (%d missing) in %.1fs: %.1f images/s'
+          % (n_images, len(pairs) - n_images, elapsed, n_images / max(elapsed, 1e-8)))
+    print(' '.join('%s: %.4f' % (key, aggregate[key]) for key in report.values))
+    return aggregate
 
 
 if __name__ == "__main__":
-
-    gt_paths, gt_size = make_dataset(args.gt_path)
-    #pre_paths, pre_size = make_dataset(args.save_path)
-
-    # for i in range(20000):
-    #     print(i)
-    #     name = gt_paths[i].split("/")[-1]
-    #     path = os.path.join(args.save_path,name)
-    #     try:
-    #         image = Image.open(path)
-    #     except:
-    #         print (path)
-
-    # assert gt_size == pre_size
-    #
-    iters = int(20000/args.num_test)
-
-    l1_loss = np.zeros(iters, np.float32)
-    PSNR = np.zeros(iters, np.float32)
-    TV = np.zeros(iters, np.float32)
-
-    for i in range(0, iters):
-        l1_iter = np.zeros(args.num_test, np.float32)
-        PSNR_iter = np.zeros(args.num_test, np.float32)
-        TV_iter = np.zeros(args.num_test, np.float32)
-
-        num = i*args.num_test
-
-        for j in range(args.num_test):
-            index = num+j
-            gt_image = Image.open(gt_paths[index]).resize([256,256]).convert('RGB')
-            gt_numpy = np.array(gt_image).astype(np.float32)
-            l1_sample = 1000
-            PSNR_sample = 0
-            TV_sample = 1000
-            name = gt_paths[index].split('/')[-1].split(".")[0]+"*"
-            pre_paths = sorted(glob.glob(os.path.join(args.save_path, name)))
-            num_image_files = len(pre_paths)
-
-            for k in range(num_image_files-1):
-                index2 = k
-                try:
-                    pre_image = Image.open(pre_paths[index2]).resize([256,256]).convert('RGB')
-                    pre_numpy = np.array(pre_image).astype(np.float32)
-                    l1_temp, PSNR_temp, TV_temp = compute_errors(gt_numpy, pre_numpy)
-                    # select the best results for the errors estimation
-                    if l1_temp - PSNR_temp + TV_temp < l1_sample - PSNR_sample + TV_sample:
-                        l1_sample, PSNR_sample, TV_sample = l1_temp, PSNR_temp, TV_temp
-                        best_index = index2
-                except:
-                    print(pre_paths[index2])
-            shutil.copy(pre_paths[best_index], '/media/lyndon/c6f4bbbd-8d47-4dcb-b0db-d788fe2b2557/dataset/image_painting/results/ours/imagenet/center_copy/')
-            print(pre_paths[best_index])
-            print(l1_sample, PSNR_sample, TV_sample)
-
-            l1_iter[j], PSNR_iter[j], TV_iter[j] = l1_sample, PSNR_sample, TV_sample
-
-        l1_loss[i] = np.mean(l1_iter)
-        PSNR[i] = np.mean(PSNR_iter)
-        TV[i] = np.mean(TV_iter)
-
-        print(i)
-        print('{:10.4f},{:10.4f},{:10.4f}'.format(l1_loss[i], PSNR[i], TV[i]))
-
-    print('{:>10},{:>10},{:>10}'.format('L1_LOSS', 'PSNR', 'TV'))
-    print('{:10.4f},{:10.4f},{:10.4f}'.format(l1_loss.mean(), PSNR.mean(), TV.mean()))
+    parser = argparse.ArgumentParser(description='Evaluate the generated images against the ground truth of the pair list')
+    parser.add_argument('--results_dir', type=str, required=True, help='directory or shard store written by test.py')
+    parser.add_argument('--dataroot', type=str, default='./dataset/fashion/')
+    parser.add_argument('--dataset_mode', type=str, default='fashion', choices=['fashion', 'market'])
+    parser.add_argument('--phase', type=str, default='test')
+    parser.add_argument('--data_name', type=str, default='vis', help='suffix of the evaluated results')
+    parser.add_argument('--data_ext', type=str, default='jpg')
+    parser.add_argument('--report_dir', type=str, default=None, help='where to write the reports, results_dir by default')
+    parser.add_argument('--nThreads', type=int, default=8, help='# processes decoding the images')
+    parser.add_argument('--batchSize', type=int, default=64)
+    args = parser.parse_args()
+
+    prefix = 'fasion' if args.dataset_mode == 'fashion' else args.dataset_mode
+    pairs = get_pairs(os.path.join(args.dataroot, '%s-pairs-%s.csv' % (prefix, args.phase)), args.data_name, args.data_ext)
+    gt_dir = os.path.join(args.dataroot, args.phase)
+    report_dir = args.results_dir if args.report_dir is None else args.report_dir
+    evaluate(args.results_dir, gt_dir, pairs, report_dir, args.nThreads, args.batchSize)
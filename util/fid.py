@@ -0,0 +1,216 @@
+import os
+import json
+import hashlib
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy import linalg
+from util.shard_store import open_results
+
+
+# the TF FID Inception of pytorch-fid, the statistics of the published FID and IS numbers
+STANDARD_BACKBONE = 'pt_inception-2015-12-05'
+
+
+class InceptionFeatures(torch.nn.Module):
+    """
+    Inception-v3 returning the 2048-d pool features (for FID) and the class logits (for IS).
+    The weights are loaded from a local file. With the pt_inception-2015-12-05 weights of pytorch-fid
+    (1008 classes, needs the pytorch-fid package) the scores are the standard FID and IS. With the
+    torchvision inception_v3 checkpoint they are not comparable to published or pytorch-fid numbers,
+    the reports name them fid_torchvision and is_torchvision.
+    """
+    def __init__(self, weights_path):
+        super(InceptionFeatures, self).__init__()
+        state_dict = torch.load(weights_path, map_location='cpu')
+        if state_dict['fc.weight'].size(0) == 1008:
+            self.backbone = STANDARD_BACKBONE
+            self.net = fid_inception_v3()
+        else:
+            self.backbone = 'torchvision'
+            print('%s holds torchvision inception_v3 weights, FID and IS are not comparable to the published numbers' 
+                  % weights_path)
+            from torchvision.models.inception import Inception3
+            try:
+                # skip the random initialization of newer torchvision versions, the weights are loaded anyway
+                self.net = Inception3(aux_logits=True, transform_input=False, init_weights=False)
+            except TypeError:
+                self.net = Inception3(aux_logits=True, transform_input=False)
+        self.net.load_state_dict(state_dict)
+        self.net.eval()
+        self.net.fc.register_forward_pre_hook(self.store_features)
+
+    def store_features(self, module, inputs):
+        self.features = inputs[0]
+
+    @torch.no_grad()
+    def forward(self, images):
+        """images: uint8 (N,H,W,C) batch"""
+        x = torch.as_tensor(images).to(next(self.net.parameters()).device)
+        x = x.permute(0, 3, 1, 2).float() / 127.5 - 1
+        x = F.interpolate(x, size=(299, 299), mode='bilinear', align_corners=False)
+        logits = self.net(x)
+        return self.features.flatten(1), logits
+
+
+def fid_inception_v3():
+    """The FID Inception of pytorch-fid without its weights, torchvision Inception3 with the TF blocks"""
+    try:
+        from pytorch_fid import inception
+    except ImportError:
+        raise ImportError('the %s weights need the pytorch-fid package, pip install pytorch-fid' % STANDARD_BACKBONE)
+    net = inception._inception_v3(num_classes=1008, aux_logits=False, weights=None)
+    net.Mixed_5b = inception.FIDInceptionA(192, pool_features=32)
+    net.Mixed_5c = inception.FIDInceptionA(256, pool_features=64)
+    net.Mixed_5d = inception.FIDInceptionA(288, pool_features=64)
+    net.Mixed_6b = inception.FIDInceptionC(768, channels_7x7=128)
+    net.Mixed_6c = inception.FIDInceptionC(768, channels_7x7=160)
+    net.Mixed_6d = inception.FIDInceptionC(768, channels_7x7=160)
+    net.Mixed_6e = inception.FIDInceptionC(768, channels_7x7=192)
+    net.Mixed_7b = inception.FIDInceptionE_1(1280)
+    net.Mixed_7c = inception.FIDInceptionE_2(2048)
+    return net
+
+
+def score_names(backbone):
+    """Report keys of FID and IS, the scores of another backbone than the standard one are named after it"""
+    suffix = '' if backbone == STANDARD_BACKBONE else '_' + backbone
+    return 'fid' + suffix, 'is' + suffix
+
+
+class FeatureStatistics():
+    """Streaming mean and covariance of the features plus the class probabilities for IS"""
+    def __init__(self, dim=2048):
+        self.n = 0
+        self.sum = np.zeros(dim, np.float64)
+        self.sum_outer = np.zeros((dim, dim), np.float64)
+        self.probs = []
+
+    def add(self, features, logits=None):
+        probs = F.softmax(logits.detach().float(), dim=1).cpu().numpy() if logits is not None else None
+        self.add_arrays(features.detach().cpu().numpy(), probs)
+
+    def add_arrays(self, features, probs=None):
+        """Add the (N,dim) features and (N,classes) class probabilities of numpy arrays"""
+        features = features.astype(np.float64)
+        self.n += features.shape[0]
+        self.sum += features.sum(0)
+        self.sum_outer += features.T.dot(features)
+        if probs is not None:
+            self.probs.append(probs)
+
+    def mean_cov(self):
+        mu = self.sum / self.n
+        sigma = (self.sum_outer - self.n * np.outer(mu, mu)) / (self.n - 1)
+        return mu, sigma
+
+    def inception_score(self, splits=10):
+        probs = np.concatenate(self.probs)
+        scores = []
+        for part in np.array_split(probs, splits):
+            kl = part * (np.log(part + 1e-12) - np.log(part.mean(0, keepdims=True) + 1e-12))
+            scores.append(np.exp(kl.sum(1).mean()))
+        return float(np.mean(scores)), float(np.std(scores))
+
+
+def frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
+    diff = mu1 - mu2
+    covmean, _ = linalg.sqrtm(sigma1.dot(sigma2), disp=False)
+    if not np.isfinite(covmean).all():
+        offset = np.eye(sigma1.shape[0]) * eps
+        covmean = linalg.sqrtm((sigma1 + offset).dot(sigma2 + offset))
+    covmean = covmean.real
+    return float(diff.dot(diff) + np.trace(sigma1) + np.trace(sigma2) - 2 * np.trace(covmean))
+
+
+_readers = {}
+
+def _load_images(item):
+    root, names = item
+    if root not in _readers:
+        _readers[root] = open_results(root)
+    images = [_readers[root].read_image(name) for name in names]
+    images = [np.stack([image] * 3, -1) if image.ndim == 2 else image[..., :3] for image in images]
+    return np.stack(images)
+
+
+def stream_images(root, names, batch_size=50, n_workers=4):
+    """Yield uint8 (N,H,W,C) batches of the named images of a directory or shard store"""
+    batches = [(root, names[i:i+batch_size]) for i in range(0, len(names), batch_size)]
+    with multiprocessing.Pool(n_workers) as pool:
+        for images in pool.imap(_load_images, batches):
+            yield images
+
+
+def compute_statistics(model, root, names, batch_size=50, n_workers=4):
+    stats = FeatureStatistics()
+    for images in stream_images(root, names, batch_size, n_workers):
+        stats.add(*model(images))
+    return stats
+
+
+def file_list_key(root, names, backbone=STANDARD_BACKBONE):
+    """Hash of the ground truth file list and backbone, the cached statistics are only valid for the same ones"""
+    key = json.dumps([os.path.abspath(root), sorted(names), backbone])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def get_gt_statistics(model, gt_root, gt_names, fid_gt_path, batch_size=50, n_workers=4):
+    """
+    Return the mean and covariance of the ground truth features. They are cached in fid_gt_path,
+    either a .npz file or a directory holding one fid_stats_<hash>.npz file per file list.
+    """
+    key = file_list_key(gt_root, gt_names, model.backbone)
+    cache_path = fid_gt_path if fid_gt_path.endswith('.npz') else os.path.join(fid_gt_path, 'fid_stats_%s.npz' % key)
+    if os.path.isfile(cache_path):
+        cache = np.load(cache_path)
+        if str(cache['key']) == key:
+            return cache['mu'], cache['sigma']
+        print('the file list or backbone of %s changed, recompute the statistics' % cache_path)
+
+    print('compute the inception statistics of %d ground truth images' % len(gt_names))
+    mu, sigma = compute_statistics(model, gt_root, gt_names, batch_size, n_workers).mean_cov()
+    if not os.path.isdir(os.path.dirname(os.path.abspath(cache_path))):
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)))
+    tmp_path = cache_path + '.tmp.npz'
+    np.savez(tmp_path, key=key, backbone=model.backbone, mu=mu, sigma=sigma)
+    os.replace(tmp_path, cache_path)
+    return mu, sigma
+
+
+if __name__ == '__main__':
+    from util.evaluation import get_pairs
+
+    parser = argparse.ArgumentParser(description='FID and IS of the generated images')
+    parser.add_argument('--results_dir', type=str, required=True, help='directory or shard store written by test.py')
+    parser.add_argument('--dataroot', type=str, default='./dataset/fashion/')
+    parser.add_argument('--dataset_mode', type=str, default='fashion', choices=['fashion', 'market'])
+    parser.add_argument('--phase', type=str, default='test')
+    parser.add_argument('--data_name', type=str, default='vis')
+    parser.add_argument('--data_ext', type=str, default='jpg')
+    parser.add_argument('--fid_gt_path', type=str, required=True, help='cache of the ground truth statistics (.npz file or directory)')
+    parser.add_argument('--inception_weights', type=str, required=True, help='local pt_inception-2015-12-05 weights of pytorch-fid, or torchvision inception_v3 weights (non-standard scores)')
+    parser.add_argument('--batchSize', type=int, default=50)
+    parser.add_argument('--nThreads', type=int, default=4)
+    parser.add_argument('--gpu_ids', type=str, default='0')
+    args = parser.parse_args()
+
+    device = torch.device('cuda') if torch.cuda.is_available() and args.gpu_ids != '-1' else torch.device('cpu')
+    model = InceptionFeatures(args.inception_weights).to(device)
+
+    prefix = 'fasion' if args.dataset_mode == 'fashion' else args.dataset_mode
+    pairs = get_pairs(os.path.join(args.dataroot, '%s-pairs-%s.csv' % (prefix, args.phase)), args.data_name, args.data_ext)
+    gt_root = os.path.join(args.dataroot, args.phase)
+    gt_names = sorted(set(gt_name for _, gt_name in pairs))
+    mu_gt, sigma_gt = get_gt_statistics(model, gt_root, gt_names, args.fid_gt_path, args.batchSize, args.nThreads)
+
+    results = open_results(args.results_dir)
+    names = [name for name, _ in pairs if name in results]
+    stats = compute_statistics(model, args.results_dir, names, args.batchSize, args.nThreads)
+    mu, sigma = stats.mean_cov()
+    fid = frechet_distance(mu, sigma, mu_gt, sigma_gt)
+    is_mean, is_std = stats.inception_score()
+    fid_name, is_name = score_names(model.backbone)
+    print('%s %.4f  %s %.4f +- %.4f (%d images)' % (fid_name, fid, is_name, is_mean, is_std, stats.n))
@@ -0,0 +1,257 @@
+import os
+import sys
+import json
+import time
+from collections import OrderedDict
+import torch
+import torch.nn as nn
+
+try:
+    from torch.utils.flop_counter import FlopCounterMode
+except ImportError:
+    FlopCounterMode = None
+
+
+COLUMNS = ['calls', 'time', 'peak_bytes', 'saved_bytes', 'output_bytes', 'param_bytes', 'flops']
+
+
+class ModuleReport():
+    """
+    Per module cost of the forward pass of one training step, measured with forward hooks on
+    every submodule of the networks and on the loss modules of a model. The backward pass is
+    only part of the totals of the step: full backward hooks wrap the outputs of the modules,
+    which fails on the in-place activations that follow them in these networks.
+    The columns are:
+      time         wall time of the forward calls (cuda is synchronized around every call)
+      peak_bytes   peak of the allocated cuda memory above the memory at the start of the call
+      saved_bytes  memory of the tensors saved for the backward pass, i.e. the activations
+                   kept alive until backward
+      output_bytes memory of the outputs
+      param_bytes  memory of the parameters
+      flops        forward flops of the aten operators (needs torch.utils.flop_counter),
+                   custom cuda extensions such as Resample2d are not counted
+    The numbers of a module include its submodules, a module called several times (e.g. net_D)
+    accumulates its calls, the peak is the maximum over the calls.
+    """
+    def __init__(self):
+        self.use_cuda = torch.cuda.is_available()
+        self.rows = OrderedDict()
+        self.stack = []
+        self.handles = []
+        self.wrapped = []
+        self.param_ptrs = set()
+        self.hooked = set()
+        self.flop_counter = None
+        self.step_peak = 0
+
+    def attach(self, model):
+        """Hook the networks net_* and the loss modules of a model"""
+        for name, value in list(vars(model).items()):
+            if not isinstance(value, nn.Module):
+                continue
+            if name.startswith('net_'):
+                self.add_module(value, name[len('net_'):])
+            elif type(value).__call__ is not nn.Module.__call__:
+                # the losses overriding __call__ bypass the hooks of their root module
+                self.add_module(value, 'loss.' + name, hook_root=False)
+                setattr(model, name, self.measured(name, value))
+                self.wrapped.append((model, name, value))
+            else:
+                self.add_module(value, 'loss.' + name)
+
+    def add_module(self, net, prefix, hook_root=True):
+        for name, module in net.named_modules():
+            full_name = prefix + '.' + name if name else prefix
+            params = list(module.parameters())
+            self.param_ptrs.update(p.data_ptr() for p in params)
+            row = OrderedDict((key, 0) for key in COLUMNS)
+            row['param_bytes'] = sum(p.numel() * p.element_size() for p in params)
+            row['depth'] = full_name.count('.') - prefix.count('.')
+            self.rows[full_name] = row
+            if id(module) in self.hooked:
+                # a module shared by two networks is measured under its first name
+                continue
+            self.hooked.add(id(module))
+            if name or hook_root:
+                self.handles.append(module.register_forward_pre_hook(self.pre_hook(full_name)))
+                self.handles.append(module.register_forward_hook(self.post_hook(full_name)))
+
+    def pre_hook(self, name):
+        def hook(module, inputs):
+            self.enter(name)
+        return hook
+
+    def post_hook(self, name):
+        def hook(module, inputs, outputs):
+            self.exit(name, outputs)
+        return hook
+
+    def measured(self, name, loss):
+        def call(*args, **kwargs):
+            self.enter('loss.' + name)
+            outputs = loss(*args, **kwargs)
+            self.exit('loss.' + name, outputs)
+            return outputs
+        return call
+
+    def enter(self, name):
+        entry = {'name': name, 'saved': set(), 'saved_bytes': 0}
+        if self.use_cuda:
+            torch.cuda.synchronize()
+            if len(self.stack) > 0:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], torch.cuda.max_memory_allocated())
+            self.reset_peak()
+            entry['start_memory'] = entry['peak'] = torch.cuda.memory_allocated()
+        entry['start_flops'] = self.flop_counter.get_total_flops() if self.flop_counter is not None else 0
+        entry['start_time'] = time.perf_counter()
+        self.stack.append(entry)
+
+    def exit(self, name, outputs):
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        entry = self.stack.pop()
+        assert entry['name'] == name, 'unbalanced module calls %s and %s' % (entry['name'], name)
+        row = self.rows[name]
+        row['calls'] += 1
+        row['time'] += time.perf_counter() - entry['start_time']
+        row['saved_bytes'] += entry['saved_bytes']
+        row['output_bytes'] += tensor_bytes(outputs)
+        if self.flop_counter is not None:
+            row['flops'] += self.flop_counter.get_total_flops() - entry['start_flops']
+        if self.use_cuda:
+            entry['peak'] = max(entry['peak'], torch.cuda.max_memory_allocated())
+            row['peak_bytes'] = max(row['peak_bytes'], entry['peak'] - entry['start_memory'])
+            if len(self.stack) > 0:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], entry['peak'])
+            self.reset_peak()
+
+    def reset_peak(self):
+        # the peak of a call is measured from its start, the peak of the whole step is kept here
+        self.step_peak = max(self.step_peak, torch.cuda.max_memory_allocated())
+        torch.cuda.reset_peak_memory_stats()
+
+    def pack(self, tensor):
+        """Count a tensor saved for backward in all modules being called"""
+        if torch.is_tensor(tensor) and tensor.data_ptr() not in self.param_ptrs:
+            key = (tensor.data_ptr(), tensor.numel(), tensor.dtype)
+            for entry in self.stack:
+                if key not in entry['saved']:
+                    entry['saved'].add(key)
+                    entry['saved_bytes'] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    def unpack(self, tensor):
+        return tensor
+
+    def run(self, step):
+        """Run step() with the hooks, return the totals of the step"""
+        if self.use_cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start_memory = torch.cuda.memory_allocated() if self.use_cuda else 0
+        self.step_peak = start_memory
+        self.flop_counter = FlopCounterMode(display=False) if FlopCounterMode is not None else None
+        start = time.perf_counter()
+        with torch.autograd.graph.saved_tensors_hooks(self.pack, self.unpack):
+            if self.flop_counter is not None:
+                with self.flop_counter:
+                    step()
+            else:
+                step()
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        totals = OrderedDict()
+        totals['time'] = time.perf_counter() - start
+        totals['start_bytes'] = start_memory
+        if self.use_cuda:
+            self.reset_peak()
+        totals['peak_bytes'] = self.step_peak - start_memory
+        totals['flops'] = self.flop_counter.get_total_flops() if self.flop_counter is not None else 0
+        totals['param_bytes'] = sum(row['param_bytes'] for name, row in self.rows.items() if row['depth'] == 0)
+        return totals
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        for model, name, value in self.wrapped:
+            setattr(model, name, value)
+        self.handles, self.wrapped = [], []
+
+    def table(self, sort='peak_bytes', depth=None, n_rows=0):
+        rows = [(name, row) for name, row in self.rows.items() if row['calls'] > 0 and (depth is None or row['depth'] <= depth)]
+        rows.sort(key=lambda item: item[1][sort], reverse=True)
+        if n_rows > 0:
+            rows = rows[:n_rows]
+        width = max([len(name) for name, _ in rows] + [6])
+        lines = ['%-*s %6s %10s %10s %10s %10s %10s %10s' % ((width, 'module') + tuple(COLUMNS))]
+        for name, row in rows:
+            lines.append('%-*s %6d %8.2fms %10s %10s %10s %10s %10s' % (width, name, row['calls'], row['time'] * 1000,
+                         format_bytes(row['peak_bytes']), format_bytes(row['saved_bytes']), format_bytes(row['output_bytes']),
+                         format_bytes(row['param_bytes']), format_count(row['flops'])))
+        return '\n'.join(lines)
+
+    def write(self, report_dir, totals, sort='peak_bytes', depth=None, n_rows=0):
+        if not os.path.isdir(report_dir):
+            os.makedirs(report_dir)
+        table = self.table(sort, depth, n_rows)
+        with open(os.path.join(report_dir, 'module_report.txt'), 'w') as f:
+            f.write(table + '\n')
+        report = {'totals': totals, 'cuda': self.use_cuda, 'flops_counted': self.flop_counter is not None,
+                  'modules_measure': 'forward', 'modules': self.rows}
+        with open(os.path.join(report_dir, 'module_report.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        return table
+
+
+def tensor_bytes(value):
+    if torch.is_tensor(value):
+        return value.numel() * value.element_size()
+    if isinstance(value, dict):
+        return sum(tensor_bytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(tensor_bytes(v) for v in value)
+    return 0
+
+
+def format_bytes(n):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(n) < 1024 or unit == 'GB':
+            return '%.1f%s' % (n, unit) if unit != 'B' else '%d%s' % (n, unit)
+        n /= 1024.0
+
+
+def format_count(n):
+    for unit in ['', 'K', 'M', 'G', 'T']:
+        if abs(n) < 1000 or unit == 'T':
+            return '%.1f%s' % (n, unit) if unit else '%d' % n
+        n /= 1000.0
+
+
+if __name__ == '__main__':
+    from options.report_options import ReportOptions
+    from model import create_model
+
+    opt = ReportOptions().parse()
+    model = create_model(opt)
+    try:
+        data = model.get_synthetic_input()
+    except NotImplementedError as e:
+        sys.exit('%s, the module report needs a model with synthetic inputs' % e)
+    for _ in range(opt.report_warmup):
+        # cudnn autotuning and lazy allocations happen in the first steps
+        model.set_input(data)
+        model.optimize_parameters()
+
+    report = ModuleReport()
+    report.attach(model)
+    model.set_input(data)
+    totals = report.run(model.optimize_parameters)
+    report.detach()
+
+    report_dir = model.save_dir if opt.report_dir is None else opt.report_dir
+    print(report.write(report_dir, totals, opt.report_sort, opt.report_depth, opt.report_rows))
+    print('modules: forward pass only, step: forward and backward')
+    print('step of batch %d: %.1fms, peak %s above %s, %s flops, %s of parameters'
+          % (opt.batchSize, totals['time'] * 1000, format_bytes(totals['peak_bytes']), format_bytes(totals['start_bytes']),
+             format_count(totals['flops']), format_bytes(totals['param_bytes'])))
+    print('report written to %s' % os.path.join(report_dir, 'module_report.json'))
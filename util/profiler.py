@@ -0,0 +1,52 @@
+import os
+import torch
+from util import util
+
+
+class Profiler():
+    """
+    Capture windows of iterations with torch.profiler. step() is called once per iteration,
+    after profile_wait iterations profile_warmup are traced and discarded and profile_active
+    are recorded. Every window writes a chrome trace (open it in chrome://tracing or
+    tensorboard) and the tables of the top-k operators to <save_dir>/profile.
+    """
+    def __init__(self, opt, save_dir, phase='train'):
+        if not hasattr(torch, 'profiler'):
+            raise RuntimeError('--profile requires torch.profiler (pytorch >= 1.8.1)')
+        self.trace_dir = os.path.join(save_dir, 'profile')
+        util.mkdir(self.trace_dir)
+        self.phase = phase
+        self.top_k = opt.profile_top_k
+        self.use_cuda = torch.cuda.is_available() and len(opt.gpu_ids) > 0
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.use_cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        schedule = torch.profiler.schedule(wait=opt.profile_wait, warmup=opt.profile_warmup, 
+                                           active=opt.profile_active, repeat=opt.profile_repeat)
+        self.profiler = torch.profiler.profile(activities=activities, schedule=schedule, on_trace_ready=self.write,
+                                               record_shapes=opt.profile_shapes, profile_memory=opt.profile_memory)
+        self.profiler.start()
+
+    def write(self, profiler):
+        name = '%s_step%d' % (self.phase, profiler.step_num)
+        trace_path = os.path.join(self.trace_dir, name + '.pt.trace.json')
+        profiler.export_chrome_trace(trace_path)
+
+        averages = profiler.key_averages()
+        sort_keys = ['self_cuda_time_total', 'cuda_time_total'] if self.use_cuda else []
+        sort_keys += ['self_cpu_time_total', 'cpu_time_total']
+        if profiler.profile_memory:
+            sort_keys += ['self_cuda_memory_usage' if self.use_cuda else 'self_cpu_memory_usage']
+        tables = ['top %d operators by %s\n%s' % (self.top_k, key, averages.table(sort_by=key, row_limit=self.top_k))
+                  for key in sort_keys]
+        table_path = os.path.join(self.trace_dir, name + '_ops.txt')
+        with open(table_path, 'w') as f:
+            f.write('\n\n'.join(tables) + '\n')
+        print(tables[0])
+        print('profile of %s written to %s and %s' % (name, trace_path, table_path))
+
+    def step(self):
+        self.profiler.step()
+
+    def stop(self):
+        self.profiler.stop()
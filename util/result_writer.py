@@ -0,0 +1,95 @@
+import io
+import os
+import queue
+import atexit
+import threading
+import numpy as np
+from PIL import Image
+
+
+class ResultWriter():
+    """
+    Encode and write result images with a pool of threads.
+    Images are given as uint8 (N,H,W,C) batches that were already converted on the device,
+    the bounded queue blocks the caller when the encoders fall behind. Pending images are
+    written by flush, which is also called at exit. With a shard store the encoded images are
+    appended to the store under their path relative to store_root instead of written as files.
+    """
+    def __init__(self, n_threads=4, max_queue=64, jpeg_quality=95, png_compress_level=6, webp_quality=90,
+                 store=None, store_root=None):
+        self.store = store
+        self.store_root = store_root
+        self.save_options = {'.jpg': {'quality': jpeg_quality},
+                             '.jpeg': {'quality': jpeg_quality},
+                             '.png': {'compress_level': png_compress_level},
+                             '.webp': {'quality': webp_quality}}
+        self.n_threads = n_threads
+        self.error = None
+        self.closed = False
+        if n_threads > 0:
+            self.queue = queue.Queue(max_queue)
+            self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(n_threads)]
+            for thread in self.threads:
+                thread.start()
+        atexit.register(self.close)
+
+    def encode(self, image, path):
+        if image.ndim == 3 and image.shape[2] == 1:
+            image = image[:, :, 0]
+        ext = os.path.splitext(path)[1].lower()
+        options = self.save_options.get(ext, {})
+        image = Image.fromarray(np.ascontiguousarray(image))
+        if self.store is None:
+            image.save(path, **options)
+        else:
+            data = io.BytesIO()
+            image.save(data, format=Image.registered_extensions()[ext], **options)
+            self.store.write(os.path.relpath(path, self.store_root), data.getvalue())
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    self.encode(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def write(self, images, paths):
+        """Queue a uint8 (N,H,W,C) batch of images to be written to the given paths"""
+        self.check()
+        for image, path in zip(images, paths):
+            if self.n_threads > 0:
+                self.queue.put((image, path))
+            else:
+                self.encode(image, path)
+
+    def flush(self):
+        """Block until all queued images are written"""
+        if self.n_threads > 0:
+            self.queue.join()
+        if self.store is not None:
+            self.store.flush()
+        self.check()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.n_threads > 0:
+            for _ in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+        if self.store is not None:
+            self.store.close()
+        self.check()
@@ -0,0 +1,145 @@
+import io
+import os
+import glob
+import json
+import mmap
+import threading
+import numpy as np
+from PIL import Image
+
+
+INDEX_PATTERN = 'index_*.jsonl'
+
+
+class ShardWriter():
+    """
+    Append encoded results to a few large shard files instead of one file per image.
+    Every writer owns its files <prefix>_<n>.bin and an index index_<prefix>.jsonl with one
+    {"name", "shard", "offset", "length"} entry per result. Entries are only appended
+    after their bytes are flushed, so an interrupted run leaves a consistent store.
+    """
+    def __init__(self, root, prefix='shard0', shard_size=1024**3):
+        self.root = root
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.lock = threading.Lock()
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.index_file = open(os.path.join(root, 'index_%s.jsonl' % prefix), 'a')
+        # never append to the shards of an earlier run
+        self.shard_id = len(glob.glob(os.path.join(root, '%s_*.bin' % prefix)))
+        self.shard_file = None
+
+    def open_shard(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+            self.shard_id += 1
+        self.shard_name = '%s_%05d.bin' % (self.prefix, self.shard_id)
+        self.shard_file = open(os.path.join(self.root, self.shard_name), 'ab')
+
+    def write(self, name, data):
+        with self.lock:
+            if self.shard_file is None or (self.shard_file.tell() > 0 and self.shard_file.tell() + len(data) > self.shard_size):
+                self.open_shard()
+            offset = self.shard_file.tell()
+            self.shard_file.write(data)
+            self.shard_file.flush()
+            self.index_file.write(json.dumps({'name': name, 'shard': self.shard_name, 'offset': offset, 'length': len(data)}) + '\n')
+
+    def flush(self):
+        with self.lock:
+            if self.shard_file is not None:
+                self.shard_file.flush()
+                os.fsync(self.shard_file.fileno())
+            self.index_file.flush()
+            os.fsync(self.index_file.fileno())
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.shard_file is not None:
+                self.shard_file.close()
+                self.shard_file = None
+            self.index_file.close()
+
+
+class ShardReader():
+    """Random access to the results of a shard store, the shards are memory-mapped"""
+    def __init__(self, root):
+        self.root = root
+        self.index = {}
+        for path in sorted(glob.glob(os.path.join(root, INDEX_PATTERN))):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a partially written last line
+                    self.index[entry['name']] = (entry['shard'], entry['offset'], entry['length'])
+        self.shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def names(self):
+        return sorted(self.index.keys())
+
+    def get_shard(self, shard):
+        if shard not in self.shards:
+            with open(os.path.join(self.root, shard), 'rb') as f:
+                self.shards[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.shards[shard]
+
+    def read(self, name):
+        """Return the encoded bytes of a result"""
+        shard, offset, length = self.index[name]
+        return self.get_shard(shard)[offset:offset+length]
+
+    def read_image(self, name):
+        """Return a result decoded to a uint8 numpy array"""
+        return np.asarray(Image.open(io.BytesIO(self.read(name))))
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.close()
+        self.shards = {}
+
+
+class DirectoryReader():
+    """The ShardReader interface for results stored as individual files"""
+    def __init__(self, root):
+        self.root = root
+        self.index = set()
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                if os.path.splitext(filename)[1].lower() in ['.png', '.jpg', '.jpeg', '.webp']:
+                    self.index.add(os.path.relpath(os.path.join(dirpath, filename), root))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def names(self):
+        return sorted(self.index)
+
+    def read(self, name):
+        with open(os.path.join(self.root, name), 'rb') as f:
+            return f.read()
+
+    def read_image(self, name):
+        return np.asarray(Image.open(os.path.join(self.root, name)))
+
+    def close(self):
+        pass
+
+
+def open_results(root):
+    """Open a results directory, stored either as a shard store or as individual files"""
+    if len(glob.glob(os.path.join(root, INDEX_PATTERN))) > 0:
+        return ShardReader(root)
+    return DirectoryReader(root)
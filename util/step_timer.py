@@ -0,0 +1,101 @@
+import json
+import time
+from collections import OrderedDict, deque
+import numpy as np
+import torch
+
+
+class StepTimer():
+    """
+    Wall time of the phases of the training steps.
+    Model methods are wrapped with wrap(model, names), the loader wait is added by the training
+    loop. With cuda the device is synchronized at the phase boundaries, so a phase includes the
+    kernels it launched. Phases running inside another phase are reported on their own, the
+    rest of the outer phase (e.g. zero_grad and the optimizer steps) is reported as 'other'.
+    Every step is appended to a JSONL log and the percentiles are taken over the last window steps.
+    """
+    def __init__(self, log_path=None, window=200):
+        self.sync = torch.cuda.is_available()
+        self.history = OrderedDict()
+        self.window = window
+        self.current = OrderedDict()
+        self.depth = 0
+        self.compute = 0.0
+        self.leaf = 0.0
+        self.n_steps = 0
+        self.n_stalls = 0
+        self.log = open(log_path, 'a') if log_path is not None else None
+
+    def wrap(self, obj, names):
+        """Time the given methods of an object, missing methods are skipped"""
+        for name in names:
+            if hasattr(obj, name):
+                setattr(obj, name, self.timed(name, getattr(obj, name)))
+
+    def timed(self, name, method):
+        def wrapper(*args, **kwargs):
+            return self.run(name, method, *args, **kwargs)
+        return wrapper
+
+    def run(self, name, method, *args, **kwargs):
+        if self.sync:
+            torch.cuda.synchronize()
+        self.depth += 1
+        leaf = self.leaf
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            if self.sync:
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start
+            self.depth -= 1
+            self.add(name, elapsed)
+            if self.leaf == leaf:
+                # no phase ran inside this one
+                self.leaf += elapsed
+            if self.depth == 0:
+                self.compute += elapsed
+
+    def add(self, name, seconds):
+        self.current[name] = self.current.get(name, 0.0) + seconds
+
+    def end_step(self, iteration, data_time):
+        """Close the step, a step is stalled when the loader wait is longer than the computation"""
+        record = OrderedDict([('iteration', iteration), ('data', data_time)])
+        record.update(self.current)
+        record['other'] = max(0.0, self.compute - self.leaf)
+        record['compute'] = self.compute
+        record['stall'] = data_time > self.compute
+        self.current = OrderedDict()
+        self.compute, self.leaf = 0.0, 0.0
+
+        self.n_steps += 1
+        self.n_stalls += int(record['stall'])
+        for key, value in record.items():
+            if key not in ('iteration', 'stall'):
+                self.history.setdefault(key, deque(maxlen=self.window)).append(value)
+        if self.log is not None:
+            self.log.write(json.dumps(record) + '\n')
+        return record
+
+    def percentiles(self, q=(50, 90, 99)):
+        return OrderedDict((key, np.percentile(list(values), q).tolist()) for key, values in self.history.items())
+
+    def summary(self, iteration):
+        """Print the rolling percentiles in ms and log them"""
+        percentiles = self.percentiles()
+        n_window = len(next(iter(self.history.values()))) if len(self.history) > 0 else 0
+        print('step timing over %d steps (ms p50/p90/p99), %d of %d steps stalled on data'
+              % (n_window, self.n_stalls, self.n_steps))
+        print(' | '.join('%s %.1f/%.1f/%.1f' % ((key,) + tuple(1000 * v for v in values))
+                         for key, values in percentiles.items()))
+        if self.log is not None:
+            self.log.write(json.dumps({'iteration': iteration, 'percentiles': percentiles,
+                                       'stalls': self.n_stalls, 'steps': self.n_steps}) + '\n')
+            self.log.flush()
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
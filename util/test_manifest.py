@@ -0,0 +1,37 @@
+import os
+import glob
+
+
+class ResultManifest():
+    """
+    Names of the test items whose results are completely written.
+    Every shard appends to its own file results_dir/manifest_<shard>_of_<shards>.txt,
+    all manifest files of the directory are read when resuming.
+    """
+    def __init__(self, results_dir, shard_id=0, num_shards=1):
+        self.results_dir = results_dir
+        self.path = os.path.join(results_dir, 'manifest_%d_of_%d.txt' % (shard_id, num_shards))
+        self.pending = []
+
+    def load(self):
+        """Return the names of all completed items"""
+        done = set()
+        for path in glob.glob(os.path.join(self.results_dir, 'manifest_*_of_*.txt')):
+            with open(path, 'r') as f:
+                done.update(line.strip() for line in f if line.strip())
+        return done
+
+    def add(self, names):
+        self.pending.extend(names)
+
+    def commit(self):
+        """Record the pending items, call only once their results are on disk"""
+        if len(self.pending) == 0:
+            return
+        if not os.path.isdir(self.results_dir):
+            os.makedirs(self.results_dir)
+        with open(self.path, 'a') as f:
+            f.write(''.join(name + '\n' for name in self.pending))
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = []
@@ -21,6 +21,23 @@ def tensor2im(image_tensor, bytes=255.0, imtype=np.uint8):
     return image_numpy.astype(imtype)
 
 
+# convert a batch of tensors into a uint8 (N,H,W,C) numpy array. Denormalization, rounding 
+# and the layout change run on the device, the uint8 result is copied with a single transfer 
+# into pinned memory, every image of the returned array is a view into that buffer
+def tensor2im_batch(image_tensor, bytes=255.0):
+    with torch.no_grad():
+        image_tensor = ((image_tensor.detach().float() + 1) / 2.0 * bytes).clamp_(0, bytes).round_()
+        image_tensor = image_tensor.to(torch.uint8).permute(0, 2, 3, 1).contiguous()
+    if not image_tensor.is_cuda:
+        return image_tensor.numpy()
+    # a new buffer for every batch (served by the pinned memory cache), as the 
+    # returned views may still be in use by the result writer
+    buffer = torch.empty(image_tensor.size(), dtype=torch.uint8, pin_memory=True)
+    buffer.copy_(image_tensor, non_blocking=True)
+    torch.cuda.current_stream(image_tensor.device).synchronize()
+    return buffer.numpy()
+
+
 # conver a tensor into a numpy array
 def tensor2array(value_tensor):
     if value_tensor.dim() == 3:
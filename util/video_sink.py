@@ -0,0 +1,61 @@
+import os
+import queue
+import threading
+import cv2
+from util import util
+
+
+class VideoSink():
+    """
+    Encode frames into a video as they are generated.
+    Frames are pushed as RGB uint8 arrays and written by a background thread,
+    the bounded queue keeps the memory constant and blocks the producer if the
+    encoder falls behind. Every frame can optionally also be saved as an image.
+    """
+    def __init__(self, video_path, fps=15, fourcc='DIVX', max_queue=16):
+        self.video_path = video_path
+        self.fps = fps
+        self.fourcc = fourcc
+        self.n_frames = 0
+        self.error = None
+        util.mkdir(os.path.dirname(os.path.abspath(video_path)))
+        self.queue = queue.Queue(max_queue)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def push(self, image, image_path=None):
+        """Queue one (H,W,3) RGB uint8 frame, also written to image_path if given"""
+        if self.error is not None:
+            raise self.error
+        self.queue.put((image, image_path))
+
+    def run(self):
+        writer = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue  # keep draining so that the producer never blocks
+            image, image_path = item
+            try:
+                if image_path is not None:
+                    util.mkdir(os.path.dirname(image_path))
+                    util.save_image(image, image_path)
+                if writer is None:
+                    height, width = image.shape[:2]
+                    writer = cv2.VideoWriter(self.video_path, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, (width, height))
+                writer.write(cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+                self.n_frames += 1
+            except Exception as e:
+                self.error = e
+        if writer is not None:
+            writer.release()
+
+    def close(self):
+        """Wait until all queued frames are encoded and finalize the video"""
+        self.queue.put(None)
+        self.thread.join()
+        print('write video %s (%d frames)' % (self.video_path, self.n_frames))
+        if self.error is not None:
+            raise self.error